@@ -2,17 +2,32 @@
 # Licensed under the AGPLv3, see LICENCE file for details.
 
 import base64
+import calendar
+import codecs
+import collections
+from concurrent import futures
+import datetime
 import hashlib
+import json
 import os
 import pipes
+import re
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 from urllib import parse
+import uuid
 
 from charmhelpers.core import (
     hookenv,
+    host,
     templating,
+    unitdata,
 )
 from charms.reactive import (
+    clear_flag,
     set_flag,
 )
 import yaml
@@ -24,6 +39,10 @@ LXC = '/usr/bin/lxc'
 LXD = '/usr/bin/lxd'
 PROFILE_TERMSERVER = 'termserver'
 PROFILE_TERMSERVER_LIMITED = 'termserver-limited'
+# Define the name prefix for warm pool containers.
+POOL_PREFIX = 'termserver-pool-'
+# Define the name of the LXD storage pool, backed by ZFS.
+ZFS_POOL = 'jujushellstorage'
 
 
 def agent_path():
@@ -36,6 +55,22 @@ def config_path():
     return os.path.join(hookenv.charm_dir(), 'files', 'config.yaml')
 
 
+def metrics_path():
+    """Get the location for the file used by the collect-metrics hook."""
+    return os.path.join(hookenv.charm_dir(), 'files', 'metrics.json')
+
+
+def stats_path():
+    """Get the location for the file including stats used by the exporter."""
+    return os.path.join(hookenv.charm_dir(), 'files', 'stats.json')
+
+
+def exporter_path():
+    """Get the location for the Prometheus exporter script."""
+    return os.path.join(
+        hookenv.charm_dir(), 'lib', 'charms', 'layer', 'jujushell_exporter.py')
+
+
 def jujushell_path():
     """Get the location for the jujushell binary."""
     return os.path.join(hookenv.charm_dir(), 'files', 'jujushell')
@@ -46,33 +81,212 @@ def termserver_path(limited=False):
     return '/var/tmp/termserver{}.tar.gz'.format('-limited' if limited else '')
 
 
-def call(command, *args, **kwargs):
+def call(command, *args, timeout=None, **kwargs):
     """Call a subprocess passing the given arguments.
 
     Take the subcommand and its parameters as args.
-    Raise an OSError with the error output in case of failure.
+    Raise an OSError with the error output in case of failure, or if the
+    command does not complete in the given timeout, in seconds.
+    """
+    _wait(_start((command,) + args, kwargs), timeout)
+
+
+def call_concurrently(commands, timeout=None):
+    """Call the given commands concurrently.
+
+    Commands are provided as sequences including the subcommand and its
+    parameters. Wait for all commands to complete, and then raise an OSError
+    for the first failed command, if any. All commands must complete in the
+    given timeout, in seconds.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    processes = []
+    for command in commands:
+        try:
+            processes.append(_start(tuple(command), {}))
+        except OSError as err:
+            processes.append(err)
+    errors = []
+    for process in processes:
+        if isinstance(process, OSError):
+            errors.append(process)
+            continue
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+        try:
+            _wait(process, remaining)
+        except OSError as err:
+            errors.append(err)
+    if errors:
+        raise errors[0]
+
+
+def _start(cmd, kwargs):
+    """Start the given command, capturing its output in the background.
+
+    The command is started in a new session, so that the whole process group,
+    including the children of a shell, can be killed on timeout.
+    Return a _Process. Raise an OSError if the command cannot be found.
     """
     pipe = subprocess.PIPE
-    cmd = (command,) + args
     cmdline = ' '.join(map(pipes.quote, cmd))
     hookenv.log('running the following: {!r}'.format(cmdline))
     try:
         process = subprocess.Popen(
-            cmd, stdin=pipe, stdout=pipe, stderr=pipe, **kwargs)
+            cmd, stdin=subprocess.DEVNULL, stdout=pipe, stderr=pipe,
+            start_new_session=True, **kwargs)
     except OSError as err:
-        raise OSError('command {!r} not found: {}'.format(command, err))
-    output, error = map(lambda msg: msg.decode('utf-8'), process.communicate())
-    retcode = process.poll()
+        raise OSError('command {!r} not found: {}'.format(cmd[0], err))
+    output, error = _Output(), _Output()
+    readers = [
+        threading.Thread(target=out.capture, args=(stream,), daemon=True)
+        for out, stream in ((output, process.stdout), (error, process.stderr))
+    ]
+    for reader in readers:
+        reader.start()
+    return _Process(cmdline, process, readers, output, error)
+
+
+def _wait(process, timeout):
+    """Wait for the given _Process to complete.
+
+    Raise an OSError if the process fails or does not complete in the given
+    timeout, in seconds.
+    """
+    try:
+        retcode = process.popen.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.popen.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.popen.wait()
+        retcode = None
+    for reader in process.readers:
+        # Processes that left the killed group may still hold its output open.
+        reader.join(timeout=None if retcode is not None else 1)
+    output = str(process.output)
+    error = str(process.error)
+    if retcode is None:
+        msg = 'command {!r} timed out after {} seconds: {!r}'.format(
+            process.cmdline, timeout, output + error)
+        hookenv.log(msg)
+        raise OSError(msg)
     if retcode:
         msg = 'command {!r} failed with retcode {}: {!r}'.format(
-            cmdline, retcode, output + error)
+            process.cmdline, retcode, output + error)
         hookenv.log(msg)
         raise OSError(msg)
-    hookenv.log('command {!r} succeeded: {!r}'.format(cmdline, output))
+    hookenv.log('command {!r} succeeded: {!r}'.format(process.cmdline, output))
+
+
+# Define a started subprocess.
+_Process = collections.namedtuple(
+    '_Process', ['cmdline', 'popen', 'readers', 'output', 'error'])
+
+
+class _Output:
+    """The output of a subprocess, captured line by line.
+
+    Only the last lines are retained when the output exceeds the size limit.
+    """
+
+    limit = 64 * 1024
+
+    def __init__(self):
+        self._lines = collections.deque()
+        self._size = 0
+        self._truncated = False
+
+    def capture(self, stream):
+        """Capture the output from the given binary stream until EOF."""
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        with stream:
+            # Read at most limit bytes at a time, so that a long line is not
+            # fully buffered before being truncated.
+            for line in iter(lambda: stream.readline(self.limit), b''):
+                # Characters split across chunks are decoded incrementally.
+                line = decoder.decode(line)
+                if self._lines and not self._lines[-1].endswith('\n'):
+                    # Continue the line read in the previous chunk.
+                    self._lines[-1] += line
+                else:
+                    self._lines.append(line)
+                self._size += len(line)
+                while self._size > self.limit and len(self._lines) > 1:
+                    self._size -= len(self._lines.popleft())
+                    self._truncated = True
+                if self._size > self.limit:
+                    # A single line exceeds the limit.
+                    self._lines[0] = self._lines[0][-self.limit:]
+                    self._size = self.limit
+                    self._truncated = True
+
+    def __str__(self):
+        output = ''.join(self._lines)
+        if self._truncated:
+            return '[...]\n' + output
+        return output
+
+
+def config_actions(keys):
+    """Return the actions required when the given config keys change.
+
+    Actions are returned as a set including the following strings:
+    - 'config': the jujushell config file must be built again;
+    - 'restart': the jujushell service must be restarted;
+    - 'reload': the jujushell service must reload its config file;
+    - 'quotas': the LXC quotas must be updated;
+    - 'image': the termserver image must be switched;
+    - 'pool': the warm pool must be refilled;
+    - 'exporter': the Prometheus exporter must be installed again.
+    All actions are required when unknown keys are changed.
+    """
+    actions = set()
+    for key in keys:
+        actions.update(_CONFIG_ACTIONS.get(key, _ALL_CONFIG_ACTIONS))
+    return actions
+
+
+# Define the actions required when config options change.
+_ALL_CONFIG_ACTIONS = (
+    'config', 'restart', 'quotas', 'image', 'pool', 'exporter')
+_CONFIG_ACTIONS = {
+    'allowed-users': ('config', 'reload'),
+    'dns-name': ('config', 'restart'),
+    'exporter-port': ('exporter',),
+    'image-retention': (),
+    'juju-addrs': ('config', 'restart'),
+    'juju-cert': ('config', 'restart'),
+    'limit-termserver': ('image',),
+    'log-level': ('config', 'reload'),
+    'metrics-port': ('config', 'restart'),
+    'lxc-quota-cpu-allowance': ('quotas',),
+    'lxc-quota-cpu-cores': ('quotas',),
+    'lxc-quota-processes': ('quotas',),
+    'lxc-quota-ram': ('quotas',),
+    'lxc-quota-tier-users': ('config', 'reload'),
+    'lxc-quota-tiers': ('config', 'reload', 'quotas'),
+    'port': ('config', 'restart'),
+    'prepare-standby-image': (),
+    'reaper-idle-window': (),
+    'reaper-stopped-age': (),
+    'session-timeout': ('config', 'reload'),
+    'tls': ('config', 'restart'),
+    'tls-cert': ('config', 'restart'),
+    'tls-key': ('config', 'restart'),
+    'tls-key-type': ('config', 'restart'),
+    'warm-pool-size': ('config', 'reload', 'pool'),
+    'welcome-message': ('config', 'reload'),
+}
 
 
 def build_config(cfg):
-    """Build and save the jujushell server config."""
+    """Build and save the jujushell server config.
+
+    Return whether the config file has been changed.
+    """
     juju_addrs = (
         _get_string(cfg, 'juju-addrs') or
         os.getenv('JUJU_API_ADDRESSES'))
@@ -81,8 +295,14 @@ def build_config(cfg):
     juju_cert = _get_string(cfg, 'juju-cert')
     if juju_cert == 'from-unit':
         juju_cert = _get_juju_cert(agent_path())
+    users = tier_users(cfg)
 
     current_ports = get_ports(cfg)
+    metrics_port = cfg.get('metrics-port')
+    if metrics_port and metrics_port in current_ports:
+        raise ValueError(
+            'metrics port {} is already used by the service'.format(
+                metrics_port))
     # TODO: it's very unfortunate that charm helpers do not allow to get the
     # previous config as a dict.
     previous_cfg = getattr(cfg, '_prev_dict', {}) or {}
@@ -100,15 +320,85 @@ def build_config(cfg):
         'image-name': IMAGE_NAME,
         'log-level': cfg['log-level'],
         'lxd-socket-path': _lxd_socket(),
+        'pool-prefix': POOL_PREFIX,
+        'pool-size': cfg.get('warm-pool-size', 0),
         'port': current_ports[0],
         'profiles': (PROFILE_TERMSERVER, PROFILE_TERMSERVER_LIMITED),
         'session-timeout': cfg.get('session-timeout', 0),
         'welcome-message': _get_string(cfg, 'welcome-message'),
     }
+    if users:
+        # Users assigned to quota tiers get the tier profile on top of the
+        # default ones.
+        data['user-profiles'] = {
+            user: [
+                PROFILE_TERMSERVER,
+                PROFILE_TERMSERVER_LIMITED,
+                tier_profile(tier),
+            ] for user, tier in users.items()
+        }
+    if metrics_port:
+        # Metrics are also served in plaintext on the loopback interface, so
+        # that local scrapes do not require TLS handshakes.
+        data['metrics-addr'] = '127.0.0.1:{}'.format(metrics_port)
     if cfg['tls']:
         data.update(_build_tls_config(cfg))
-    with open(config_path(), 'w') as stream:
-        yaml.safe_dump(data, stream=stream)
+    _write_metrics(data)
+    # The file is replaced atomically so that the running service, when asked
+    # to reload its configuration, never reads a partially written file.
+    return _write_file(config_path(), dump_yaml(data))
+
+
+def _write_metrics(config):
+    """Write what the collect-metrics hook needs into the metrics file.
+
+    The hook runs frequently, so the metrics URL and the names of metrics are
+    precomputed here: see jujushell_metrics.
+    """
+    with open(os.path.join(hookenv.charm_dir(), 'metrics.yaml')) as stream:
+        metrics = load_yaml(stream).get('metrics') or {}
+    _write_file(metrics_path(), json.dumps({
+        'metrics': sorted(metrics),
+        'urls': service_urls(config),
+    }, sort_keys=True))
+
+
+def _write_file(path, content):
+    """Atomically write the given content to the file at the given path.
+
+    The content is written to a temporary file in the same directory, which
+    is flushed to disk and then renamed to the given path. Nothing is written
+    if the file already has the given content.
+    Return whether the file has been changed.
+    """
+    data = content.encode('utf-8')
+    try:
+        current = _sha256(path)
+    except FileNotFoundError:
+        current = None
+    if current == hashlib.sha256(data).hexdigest():
+        hookenv.log('{} is already up to date'.format(path))
+        return False
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(data)
+            stream.flush()
+            os.fsync(stream.fileno())
+        # The jujushell service does not run as root.
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+    # Also persist the rename itself.
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return True
 
 
 def _build_tls_config(cfg):
@@ -125,7 +415,8 @@ def _build_tls_config(cfg):
             'tls-key': base64.b64decode(key).decode('utf-8'),
         }
     # Automatically generate a self-signed certificate.
-    key, cert = _get_self_signed_cert()
+    key, cert = _get_self_signed_cert(
+        _get_string(cfg, 'tls-key-type') or 'rsa')
     return {'tls-cert': cert, 'tls-key': key}
 
 
@@ -144,16 +435,137 @@ def get_ports(cfg):
 
 
 def update_lxc_quotas(cfg):
-    """Update the default profile to include resource limits from config."""
+    """Update the termserver profile to include resource limits from config.
+
+    All limits are saved with a single profile update, which is skipped if
+    the profile already includes the requested limits. Empty limits are
+    removed from the profile. Quota tiers are also
+    rendered as separate profiles: see quota_tiers.
+    Return whether the termserver profile has been changed.
+    """
+    quotas = {
+        'limits.cpu': _get_string(cfg, 'lxc-quota-cpu-cores'),
+        'limits.cpu.allowance': _get_string(cfg, 'lxc-quota-cpu-allowance'),
+        'limits.memory': _get_string(cfg, 'lxc-quota-ram'),
+        'limits.processes': _get_string(cfg, 'lxc-quota-processes'),
+    }
+    client = _lxd_client()
+    _update_tier_profiles(client, quota_tiers(cfg))
+    profile = client.profiles.get(PROFILE_TERMSERVER)
+    config = dict(profile.config)
+    for key, value in quotas.items():
+        if value:
+            config[key] = value
+        else:
+            # LXD drops keys with empty values: remove them instead.
+            config.pop(key, None)
+    if config == profile.config:
+        hookenv.log('LXC quotas are already up to date')
+        return False
     hookenv.status_set('maintenance', 'updating LXC quotas')
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.cpu',
-         _get_string(cfg, 'lxc-quota-cpu-cores'))
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.cpu.allowance',
-         _get_string(cfg, 'lxc-quota-cpu-allowance'))
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.memory',
-         _get_string(cfg, 'lxc-quota-ram'))
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.processes',
-         _get_string(cfg, 'lxc-quota-processes'))
+    profile.config = config
+    profile.save(wait=True)
+    return True
+
+
+def quota_tiers(cfg):
+    """Return the LXC quota tiers defined in the given config.
+
+    Tiers are returned as a dict mapping tier names to the LXD limits of the
+    corresponding profile. Each tier profile is applied on top of the
+    termserver one for users assigned to the tier, so only the limits
+    specified for the tier are overridden.
+    Raise a ValueError if the tiers definition is not valid.
+    """
+    content = _get_string(cfg, 'lxc-quota-tiers')
+    try:
+        tiers = load_yaml(content) if content else {}
+    except yaml.YAMLError as err:
+        raise ValueError('invalid LXC quota tiers: {}'.format(err))
+    if not isinstance(tiers, dict):
+        raise ValueError('invalid LXC quota tiers: not a mapping')
+    result = {}
+    for name, quotas in tiers.items():
+        name = str(name)
+        if not _TIER_NAME.match(name) or not isinstance(quotas, dict):
+            raise ValueError('invalid LXC quota tier {!r}'.format(name))
+        limits = {}
+        for key, value in quotas.items():
+            if key not in _TIER_LIMITS:
+                raise ValueError(
+                    'invalid quota {!r} in LXC quota tier {!r}'.format(
+                        key, name))
+            limits[_TIER_LIMITS[key]] = str(value).strip()
+        result[name] = limits
+    return result
+
+
+def tier_users(cfg):
+    """Return a dict mapping users to the LXC quota tier they are assigned to.
+
+    Raise a ValueError if the assignments are not valid or if they refer to
+    tiers that are not defined.
+    """
+    tiers = quota_tiers(cfg)
+    users = {}
+    for assignment in _get_string(cfg, 'lxc-quota-tier-users').split():
+        user, sep, tier = assignment.partition('=')
+        if not (user and sep and tier):
+            raise ValueError(
+                'invalid LXC quota tier assignment {!r}'.format(assignment))
+        if tier not in tiers:
+            raise ValueError(
+                'unknown LXC quota tier {!r} for user {}'.format(tier, user))
+        users[user] = tier
+    return users
+
+
+def tier_profile(tier):
+    """Return the name of the LXD profile for the given LXC quota tier."""
+    return _TIER_PROFILE_PREFIX + tier
+
+
+def _update_tier_profiles(client, tiers):
+    """Make LXD profiles reflect the given LXC quota tiers.
+
+    Profiles are created or updated only when required. Profiles of tiers
+    that are no longer defined are removed, unless they are still in use.
+    """
+    from pylxd import exceptions  # pylxd is not immediately available.
+    existing = set(
+        profile.name for profile in client.profiles.all()
+        if profile.name.startswith(_TIER_PROFILE_PREFIX))
+    for tier, limits in sorted(tiers.items()):
+        name = tier_profile(tier)
+        if name not in existing:
+            hookenv.log('creating LXC quota tier profile {}'.format(name))
+            client.profiles.create(name, config=limits)
+            continue
+        existing.remove(name)
+        profile = client.profiles.get(name)
+        if profile.config != limits:
+            hookenv.log('updating LXC quota tier profile {}'.format(name))
+            profile.config = limits
+            profile.save(wait=True)
+    for name in sorted(existing):
+        hookenv.log('removing LXC quota tier profile {}'.format(name))
+        try:
+            client.profiles.get(name).delete()
+        except exceptions.LXDAPIException as err:
+            hookenv.log('cannot remove profile {}: {}'.format(name, err))
+
+
+# Define the LXC quotas that can be specified for quota tiers, mapped to the
+# corresponding LXD profile keys, the prefix of quota tier profile names and
+# the regular expression used to validate tier names.
+_TIER_LIMITS = {
+    'cpu-allowance': 'limits.cpu.allowance',
+    'cpu-cores': 'limits.cpu',
+    'processes': 'limits.processes',
+    'ram': 'limits.memory',
+}
+_TIER_PROFILE_PREFIX = PROFILE_TERMSERVER + '-tier-'
+_TIER_NAME = re.compile(r'^[a-z0-9][a-z0-9-]*$')
 
 
 def _get_string(cfg, key):
@@ -165,36 +577,205 @@ def _get_juju_cert(path):
     """Return the certificate to use when connecting to the controller.
 
     The certificate is provided in PEM format and it is retrieved by parsing
-    agent.conf.
+    agent.conf. The certificate is cached in the unit key/value store, so that
+    agent.conf is only parsed again when it changes.
     """
+    st = os.stat(path)
+    signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+    kv = unitdata.kv()
+    cached = kv.get(_JUJU_CERT_KEY)
+    if cached and cached['signature'] == signature:
+        return cached['cert']
     with open(path) as stream:
-        return yaml.safe_load(stream)['cacert']
-
-
-def _get_self_signed_cert():
-    """Create and return a self signed TLS certificate."""
-    call('openssl', 'req',
-         '-x509',
-         '-newkey', 'rsa:4096',
-         '-keyout', 'key.pem',
-         '-out', 'cert.pem',
-         '-days', '365',
-         '-nodes',
-         '-subj', '/C=GB/ST=London/L=London/O=Canonical/OU=JAAS/CN=0.0.0.0')
-    with open('key.pem') as keyfile:
-        key = keyfile.read()
-    with open('cert.pem') as certfile:
-        cert = certfile.read()
-    os.remove('cert.pem')
-    os.remove('key.pem')
+        cert = load_yaml(stream)['cacert']
+    kv.set(_JUJU_CERT_KEY, {'cert': cert, 'signature': signature})
+    return cert
+
+
+# Define the unit key/value store key used for caching the Juju certificate.
+_JUJU_CERT_KEY = 'jujushell.juju-cert'
+
+
+def load_yaml(stream):
+    """Load and return the YAML document in the given stream or string.
+
+    The libyaml based loader is used when available, as it is much faster
+    than the pure Python one.
+    """
+    return yaml.load(stream, Loader=_YAML_LOADER)
+
+
+def dump_yaml(data):
+    """Return the given data serialized as YAML.
+
+    The libyaml based dumper is used when available.
+    """
+    return yaml.dump(data, Dumper=_YAML_DUMPER, default_flow_style=False)
+
+
+# Define the YAML loader and dumper, preferring the ones provided by libyaml.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def _get_self_signed_cert(key_type):
+    """Return a self signed TLS key and certificate.
+
+    The key pair is stored in the unit key/value store, and it is reused
+    until it is about to expire or a different key type is requested.
+    """
+    kv = unitdata.kv()
+    now = time.time()
+    cached = kv.get(_CERT_KEY)
+    if (cached and cached['key-type'] == key_type and
+            cached['expires'] - now > _CERT_RENEWAL):
+        return cached['key'], cached['cert']
+    hookenv.log('generating self signed {} certificate'.format(key_type))
+    key, cert = _create_self_signed_cert(key_type)
+    kv.set(_CERT_KEY, {
+        'cert': cert,
+        'expires': now + _CERT_VALIDITY,
+        'key': key,
+        'key-type': key_type,
+    })
     return key, cert
 
 
+def _create_self_signed_cert(key_type):
+    """Create and return a self signed TLS key and certificate.
+
+    The key pair is generated in memory, so that the private key is never
+    written to disk.
+    """
+    # The cryptography library is installed as a dependency of pylxd, which
+    # is not immediately available.
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.x509.oid import NameOID
+    backend = default_backend()
+    if key_type == 'ecdsa':
+        key = ec.generate_private_key(ec.SECP256R1(), backend)
+    elif key_type == 'rsa':
+        key = rsa.generate_private_key(65537, 4096, backend)
+    else:
+        raise ValueError('invalid TLS key type: {}'.format(key_type))
+    name = x509.Name([
+        x509.NameAttribute(getattr(NameOID, oid), value)
+        for oid, value in _CERT_SUBJECT
+    ])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(
+        name
+    ).issuer_name(
+        name
+    ).public_key(
+        key.public_key()
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now
+    ).not_valid_after(
+        now + datetime.timedelta(seconds=_CERT_VALIDITY)
+    ).sign(key, hashes.SHA256(), backend)
+    key_pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption())
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    return key_pem.decode('ascii'), cert_pem.decode('ascii')
+
+
+# Define the unit key/value store key used for storing the self signed
+# certificate, the validity of the certificate and the time before expiration
+# when the certificate is renewed, in seconds.
+_CERT_KEY = 'jujushell.self-signed-cert'
+_CERT_VALIDITY = 365 * 24 * 60 * 60
+_CERT_RENEWAL = 30 * 24 * 60 * 60
+# Define the subject of self signed certificates.
+_CERT_SUBJECT = (
+    ('COUNTRY_NAME', 'GB'),
+    ('STATE_OR_PROVINCE_NAME', 'London'),
+    ('LOCALITY_NAME', 'London'),
+    ('ORGANIZATION_NAME', 'Canonical'),
+    ('ORGANIZATIONAL_UNIT_NAME', 'JAAS'),
+    ('COMMON_NAME', '0.0.0.0'),
+)
+
+
+def termserver_resource(limited=False):
+    """Get the name of the termserver image resource."""
+    return 'limited-termserver' if limited else 'termserver'
+
+
+def fetch_resource(name, path):
+    """Start retrieving the resource with the given name in the background.
+
+    The resource is saved in the given path. Resources are retrieved
+    concurrently. Return a future for the retrieval: if the resource is
+    already being retrieved, return the existing future.
+    """
+    global _resource_executor
+    future = _resource_futures.get(name)
+    if future is None:
+        if _resource_executor is None:
+            _resource_executor = futures.ThreadPoolExecutor(max_workers=3)
+        future = _resource_executor.submit(_fetch_resource, name, path)
+        _resource_futures[name] = future
+    return future
+
+
 def save_resource(name, path):
     """Retrieve a resource with the given name and save it in the given path.
 
+    If the resource is already being retrieved in the background, wait for
+    the retrieval to complete.
     Raise an OSError if the resource cannot be retrieved.
     """
+    try:
+        fetch_resource(name, path).result()
+    finally:
+        _resource_futures.pop(name, None)
+    _forget_fingerprint(path)
+    set_flag('jujushell.resource.available.{}'.format(name))
+
+
+def remove_resource(name, path):
+    """Remove the resource with the given name saved in the given path."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    _forget_fingerprint(path)
+    clear_flag('jujushell.resource.available.{}'.format(name))
+
+
+def save_resource_in_background(name, path):
+    """Retrieve a resource with the given name and save it in the given path.
+
+    Do not wait for the resource to be retrieved: the retrieval is completed
+    when the hook exits, and errors are only logged. Do nothing if the
+    resource is already being retrieved.
+    """
+    if name in _resource_futures:
+        return
+
+    def save():
+        try:
+            save_resource(name, path)
+        except OSError as err:
+            hookenv.log('cannot save resource {!r}: {}'.format(name, err))
+    fetch_resource(name, path)
+    hookenv.atexit(save)
+
+
+def _fetch_resource(name, path):
+    """Retrieve a resource with the given name and save it in the given path.
+
+    This is run in a separate thread, so it must not access the unit
+    key/value store. Raise an OSError if the resource cannot be retrieved.
+    """
     hookenv.log('retrieving resource {!r}'.format(name))
     resource = hookenv.resource_get(name)
     if not resource:
@@ -203,7 +784,12 @@ def save_resource(name, path):
         raise OSError(msg)
     os.rename(resource, path)
     hookenv.log('resource {!r} saved at {!r}'.format(name, path))
-    set_flag('jujushell.resource.available.{}'.format(name))
+
+
+# Define the executor used for retrieving resources in the background, and
+# the retrievals in progress, as a mapping from resource names to futures.
+_resource_executor = None
+_resource_futures = {}
 
 
 def install_service():
@@ -220,24 +806,234 @@ def install_service():
     build_config(hookenv.config())
     # Enable the jujushell module.
     hookenv.status_set('maintenance', 'enabling systemd module')
-    call('systemctl', 'enable', '/usr/lib/systemd/user/jujushell.service')
-    call('systemctl', 'daemon-reload')
+    call('systemctl', 'enable', '/usr/lib/systemd/user/jujushell.service',
+         timeout=60)
+    call('systemctl', 'daemon-reload', timeout=60)
     set_flag('jujushell.service.installed')
     hookenv.status_set('maintenance', 'jujushell installed')
 
 
+def install_exporter(port):
+    """Install and start the Prometheus exporter systemd service.
+
+    The exporter is stopped and removed if the given port is 0.
+    """
+    path = '/usr/lib/systemd/user/jujushell-exporter.service'
+    if not port:
+        if os.path.exists(path):
+            hookenv.status_set('maintenance', 'removing the exporter')
+            call('systemctl', 'disable', '--now', 'jujushell-exporter',
+                 timeout=60)
+            os.remove(path)
+            call('systemctl', 'daemon-reload', timeout=60)
+        set_flag('jujushell.exporter.installed')
+        return
+    hookenv.status_set('maintenance', 'installing the exporter')
+    templating.render('jujushell-exporter.service', path, {
+        'exporter': exporter_path(),
+        'lxd_socket': _lxd_socket(),
+        'metrics': metrics_path(),
+        'pool_prefix': POOL_PREFIX,
+        'port': port,
+        'stats': stats_path(),
+        'zfs_pool': ZFS_POOL,
+    }, perms=775)
+    call('systemctl', 'enable', path, timeout=60)
+    call('systemctl', 'daemon-reload', timeout=60)
+    call('systemctl', 'restart', 'jujushell-exporter', timeout=60)
+    set_flag('jujushell.exporter.installed')
+
+
+def prometheus_port(cfg):
+    """Return the port Prometheus uses for scraping metrics.
+
+    When the exporter is enabled, the jujushell service metrics are included
+    in the ones published by the exporter.
+    """
+    return cfg.get('exporter-port') or get_ports(cfg)[0]
+
+
 def import_lxd_image(name, path):
-    """Import the image with the given name from the given path into lxd."""
-    # Load the whole file into memory as this is necessary when creating the
-    # image.
-    with open(path, 'rb') as f:
-        data = f.read()
-    h = hashlib.sha256()
-    h.update(data)
-    fingerprint = h.hexdigest()
+    """Import the image with the given name from the given path into lxd.
+
+    Return whether the alias with the given name has been changed to refer
+    to the imported image.
+    """
+    fingerprint = _fingerprint(path)
     hookenv.log('{} has fingerprint {}'.format(path, fingerprint))
 
     client = _lxd_client()
+    image, alias = _find_lxd_images(client, fingerprint, name)
+    if image is None:
+        hookenv.status_set('maintenance',
+                           'importing image {}'.format(fingerprint))
+        start = time.monotonic()
+        image = _create_lxd_image(client, path, fingerprint)
+        _record_image_import(name, time.monotonic() - start)
+    changed = _set_lxd_alias(name, image, alias)
+    set_flag('jujushell.lxd.image.imported.{}'.format(name))
+    return changed
+
+
+def import_lxd_image_in_background(name, path):
+    """Import the image with the given name from the given path into lxd.
+
+    Unlike import_lxd_image, the image is uploaded by a transient systemd
+    unit, so that hooks are not stalled while large images are imported.
+    Return whether the image has been imported and aliased: if not, the
+    import is in progress, and this function must be called again in a later
+    hook. Failed imports are started again.
+    """
+    unit = 'jujushell-import-{}'.format(name)
+    if host.service_running(unit):
+        return False
+    fingerprint = _fingerprint(path)
+    client = _lxd_client()
+    image, alias = _find_lxd_images(client, fingerprint, name)
+    if image is not None:
+        _set_lxd_alias(name, image, alias)
+        set_flag('jujushell.lxd.image.imported.{}'.format(name))
+        return True
+    if host.service('is-failed', unit):
+        # Systemd keeps failed transient units, which must be reset before
+        # starting a unit with the same name.
+        hookenv.log('previous import of image {} failed'.format(name))
+        call('systemctl', 'reset-failed', unit, timeout=60)
+    hookenv.log('importing image {} in the background'.format(fingerprint))
+    call('systemd-run', '--unit', unit, LXC, 'image', 'import', path,
+         timeout=60)
+    return False
+
+
+def _record_image_import(name, seconds):
+    """Store how long it took to import the image with the given name.
+
+    Import durations are published by the Prometheus exporter.
+    """
+    path = stats_path()
+    try:
+        with open(path) as stream:
+            stats = json.load(stream)
+    except (OSError, ValueError):
+        stats = {}
+    stats.setdefault('image-imports', {})[name] = {
+        'seconds': seconds,
+        'time': time.time(),
+    }
+    _write_file(path, json.dumps(stats, sort_keys=True))
+
+
+def switch_lxd_image(name, source):
+    """Make the alias with the given name refer to the image aliased as source.
+
+    No images are uploaded, so switching is fast.
+    Return whether the alias with the given name has been changed.
+    Raise a ValueError if there is no image aliased as source.
+    """
+    client = _lxd_client()
+    image = _get_lxd_image(client.images.get_by_alias, source)
+    if image is None:
+        raise ValueError('cannot find image {}'.format(source))
+    alias = _get_lxd_image(client.images.get_by_alias, name)
+    changed = _set_lxd_alias(name, image, alias)
+    set_flag('jujushell.lxd.image.imported.{}'.format(name))
+    return changed
+
+
+def image_variant(limited=False):
+    """Get the alias of the LXD image for the given termserver variant."""
+    return '{}-{}'.format(IMAGE_NAME, 'limited' if limited else 'full')
+
+
+def _set_lxd_alias(name, image, alias):
+    """Make the alias with the given name refer to the given image.
+
+    The alias currently refers to the given alias image, or it does not
+    exist if alias is None. Return whether the alias has been changed.
+    """
+    if alias is None:
+        image.add_alias(name, '')
+        return True
+    if alias.fingerprint != image.fingerprint:
+        alias.delete_alias(name)
+        image.add_alias(name, '')
+        return True
+    return False
+
+
+def collect_lxd_images(keep, dry=False):
+    """Remove old LXD images, only keeping the given number of recent ones.
+
+    Images with aliases and images used by existing containers are never
+    removed. If dry is True, then do not actually remove images.
+
+    Return the fingerprints of the removed images as a sequence and the
+    number of bytes reclaimed. Raise a ValueError if keep is negative.
+    """
+    if keep < 0:
+        raise ValueError('invalid number of images to keep: {}'.format(keep))
+    client = _lxd_client()
+    used = set(
+        container.config.get('volatile.base_image')
+        for container in _list_containers(client))
+    images = sorted(
+        client.images.all(), key=lambda image: image.uploaded_at, reverse=True)
+    removed, reclaimed = [], 0
+    for image in images[keep:]:
+        if image.aliases or image.fingerprint in used:
+            continue
+        removed.append(image.fingerprint)
+        reclaimed += image.size
+        if dry:
+            continue
+        hookenv.log('removing image {}'.format(image.fingerprint))
+        image.delete(wait=True)
+    hookenv.log('{} bytes reclaimed by removing {} images'.format(
+        reclaimed, len(removed)))
+    return tuple(removed), reclaimed
+
+
+def _find_lxd_images(client, fingerprint, name):
+    """Return the image with the given fingerprint and the one aliased as name.
+
+    None is returned in place of images that cannot be found. Images are
+    looked up directly by fingerprint and alias, so that the number of API
+    calls does not depend on how many images are stored in LXD. If the LXD
+    server cannot resolve those requests, fall back to scanning all images.
+    """
+    from pylxd import exceptions  # pylxd is not immediately available.
+    try:
+        image = _get_lxd_image(client.images.get, fingerprint)
+        alias = _get_lxd_image(client.images.get_by_alias, name)
+    except exceptions.LXDAPIException as err:
+        hookenv.log('cannot look up images, scanning all: {}'.format(err))
+        return _scan_lxd_images(client, fingerprint, name)
+    if image is not None:
+        hookenv.log('image {} already exists'.format(fingerprint))
+    if alias is not None:
+        hookenv.log('alias {} currently refers to image {}'.format(
+            name, alias.fingerprint))
+    return image, alias
+
+
+def _get_lxd_image(getter, key):
+    """Return the image retrieved by calling getter with the given key.
+
+    Return None if the image is not found.
+    """
+    from pylxd import exceptions  # pylxd is not immediately available.
+    try:
+        return getter(key)
+    except exceptions.NotFound:
+        return None
+
+
+def _scan_lxd_images(client, fingerprint, name):
+    """Return the image with the given fingerprint and the one aliased as name.
+
+    All images are retrieved and inspected. None is returned in place of
+    images that cannot be found.
+    """
     image = None
     alias = None
     for img in client.images.all():
@@ -250,16 +1046,67 @@ def import_lxd_image(name, path):
                     name,
                     img.fingerprint))
                 alias = img
-    if image is None:
-        hookenv.status_set('maintenance',
-                           'importing image {}'.format(fingerprint))
-        image = client.images.create(data, wait=True)
-    if alias is None:
-        image.add_alias(name, '')
-    elif alias.fingerprint != fingerprint:
-        alias.delete_alias(name)
-        image.add_alias(name, '')
-    set_flag('jujushell.lxd.image.imported.{}'.format(name))
+    return image, alias
+
+
+def _fingerprint(path):
+    """Return the SHA256 fingerprint of the file at the given path.
+
+    Fingerprints are cached in the unit key/value store, keyed by path, and
+    reused as long as the file size, modification time and inode do not
+    change, so that big images are not hashed again on every config change.
+    """
+    info = os.stat(path)
+    signature = [info.st_size, info.st_mtime_ns, info.st_ino]
+    kv = unitdata.kv()
+    cache = kv.get(_FINGERPRINTS_KEY, {})
+    entry = cache.get(path)
+    if entry and entry['signature'] == signature:
+        return entry['fingerprint']
+    fingerprint = _sha256(path)
+    cache[path] = {'signature': signature, 'fingerprint': fingerprint}
+    kv.set(_FINGERPRINTS_KEY, cache)
+    return fingerprint
+
+
+def _forget_fingerprint(path):
+    """Remove the cached fingerprint for the file at the given path."""
+    kv = unitdata.kv()
+    cache = kv.get(_FINGERPRINTS_KEY, {})
+    if cache.pop(path, None) is not None:
+        kv.set(_FINGERPRINTS_KEY, cache)
+
+
+def _sha256(path):
+    """Return the SHA256 hash of the file at the given path.
+
+    The file is read in chunks so that memory usage does not depend on the
+    size of the file, which can be several GB for termserver images.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _create_lxd_image(client, path, fingerprint):
+    """Upload the image at the given path to LXD and return the new image.
+
+    The pylxd images.create API requires the whole image to be loaded in
+    memory, so the LXD REST API is used directly instead: passing the open
+    file to the request makes the image content be streamed to the server.
+    """
+    with open(path, 'rb') as f:
+        response = client.api.images.post(data=f)
+    client.operations.wait_for_operation(response.json()['operation'])
+    return client.images.get(fingerprint)
+
+
+# Define the size of chunks used when reading image files.
+_CHUNK_SIZE = 1024 * 1024
+# Define the unit key/value store key used for caching image fingerprints.
+_FINGERPRINTS_KEY = 'jujushell.fingerprints'
 
 
 def _lxd_client():
@@ -296,8 +1143,8 @@ def setup_lxd():
             initialized = True
             break
     if not initialized:
-        call(_LXD_INIT_COMMAND, shell=True, cwd=cwd)
-    call(_LXD_WAIT_COMMAND, shell=True, cwd=cwd)
+        call(_LXD_INIT_COMMAND, shell=True, cwd=cwd, timeout=600)
+    call(_LXD_WAIT_COMMAND, shell=True, cwd=cwd, timeout=60)
     set_flag('jujushell.lxd.configured')
 
 
@@ -311,14 +1158,14 @@ networks:
     ipv4.address: auto
     ipv6.address: none
 storage_pools:
-- name: jujushellstorage
+- name: {pool}
   driver: zfs
 profiles:
 - name: {termserver}
   devices:
     root:
       path: /
-      pool: jujushellstorage
+      pool: {pool}
       type: disk
     eth0:
       name: eth0
@@ -335,44 +1182,271 @@ profiles:
 EOF
 """.format(
     lxd=LXD,
+    pool=ZFS_POOL,
     termserver=PROFILE_TERMSERVER,
     termserver_limited=PROFILE_TERMSERVER_LIMITED)
 _LXD_WAIT_COMMAND = '{} waitready --timeout=30'.format(LXD)
 
 
-def exterminate_containers(name=None, only_stopped=False, dry=False):
+def exterminate_containers(
+        name=None, only_stopped=False, dry=False, parallelism=1):
     """Remove containers existing in the unit.
 
     If the container name is provided, remove the container with the given
     name, otherwise remove all containers. If only_stopped is True, remove
     containers only if they are stopped. Id dry is True, then do not actually
-    remove containers.
+    remove containers. Up to the given parallelism containers are removed
+    concurrently. Failing to remove a container does not prevent the other
+    ones from being removed.
 
-    Return the names of containers that have been removed as a sequence.
+    Return an Extermination including the names of containers that have been
+    removed as a sequence, and mappings from container names to error
+    messages for failures and to removal times in seconds.
     """
     client = _lxd_client()
-    removed = []
-    for container in client.containers.all():
-        if name and (container.name != name):
-            continue
-        is_running = container.status.lower() == 'running'
+    selected = []
+    for container in _list_containers(client, name=name):
+        # Frozen containers must also be stopped before being deleted.
+        is_running = container.status.lower() != 'stopped'
         if only_stopped and is_running:
             continue
-        removed.append(container.name)
-        if dry:
+        selected.append((container, is_running))
+    if dry:
+        return Extermination(
+            tuple(container.name for container, _ in selected), {}, {})
+    removed, failed, durations = [], {}, {}
+    with futures.ThreadPoolExecutor(max_workers=max(parallelism, 1)) as ex:
+        results = [
+            (container.name, ex.submit(_remove_container, container, running))
+            for container, running in selected
+        ]
+        for container_name, future in results:
+            try:
+                durations[container_name] = future.result()
+            except Exception as err:
+                msg = 'cannot remove container {}: {}'.format(
+                    container_name, err)
+                hookenv.log(msg)
+                failed[container_name] = str(err)
+                continue
+            removed.append(container_name)
+    return Extermination(tuple(removed), failed, durations)
+
+
+def _list_containers(client, name=None):
+    """Return the containers existing in the unit as a list.
+
+    If the container name is provided, only return the container with the
+    given name, if it exists. Otherwise, retrieve all containers with their
+    status and config using a single API call, rather than syncing each
+    container separately.
+    """
+    from pylxd import exceptions  # pylxd is not immediately available.
+    if name:
+        try:
+            return [client.containers.get(name)]
+        except exceptions.NotFound:
+            return []
+    response = client.api.containers.get(params={'recursion': 1})
+    return [
+        _container_from_data(client, data)
+        for data in response.json()['metadata']
+    ]
+
+
+def _container_from_data(client, data):
+    """Return a container model built from the given LXD API data."""
+    from pylxd import models  # pylxd is not immediately available.
+    attributes = models.Container.__attributes__
+    return models.Container(client, **dict(
+        (key, value) for key, value in data.items() if key in attributes))
+
+
+def _remove_container(container, is_running):
+    """Stop if running and then delete the given container.
+
+    Return the time spent in seconds.
+    """
+    start = time.monotonic()
+    if is_running:
+        container.stop(wait=True)
+    container.delete(wait=True)
+    return time.monotonic() - start
+
+
+# Define the results of removing containers.
+Extermination = collections.namedtuple(
+    'Extermination', ['removed', 'failed', 'durations'])
+
+
+def reap_containers(stopped_age, idle_window):
+    """Remove old stopped containers and freeze idle running containers.
+
+    Stopped containers not used for the given number of minutes are removed.
+    Running containers that did not use CPU for the given number of minutes
+    are frozen, and they are removed after being frozen for stopped_age
+    minutes. CPU usage is sampled every time this function is called, and
+    samples, as well as the times when containers are first seen frozen, are
+    stored in the unit key/value store. A zero value for stopped_age or
+    idle_window disables the corresponding operation. Warm pool containers
+    are ignored. Containers that cannot be removed or frozen are skipped.
+
+    Return the names of removed containers and the names of frozen
+    containers as sequences.
+    """
+    if not (stopped_age or idle_window):
+        return (), ()
+    from pylxd import exceptions  # pylxd is not immediately available.
+    client = _lxd_client()
+    now = time.time()
+    kv = unitdata.kv()
+    samples, new_samples = kv.get(_CPU_SAMPLES_KEY, {}), {}
+    frozen_since, new_frozen_since = kv.get(_FROZEN_KEY, {}), {}
+    removed, frozen = [], []
+    # Retrieve containers including their state with a single API call.
+    response = client.api.containers.get(params={'recursion': 2})
+    for data in response.json()['metadata']:
+        name, status = data['name'], data['status'].lower()
+        if name.startswith(POOL_PREFIX):
+            continue
+        if status == 'frozen':
+            # Containers frozen by a previous pass, or by someone else, are
+            # aged from when they were first seen frozen.
+            since = new_frozen_since[name] = frozen_since.get(name, now)
+            if not stopped_age or now - since < stopped_age * 60:
+                continue
+        elif status == 'stopped':
+            last_used = max(
+                _parse_time(data.get('last_used_at')),
+                _parse_time(data.get('created_at')))
+            if not stopped_age or now - last_used < stopped_age * 60:
+                continue
+        if status in ('frozen', 'stopped'):
+            hookenv.log('removing {} container {}'.format(status, name))
+            try:
+                _remove_container(
+                    _container_from_data(client, data), status == 'frozen')
+            except exceptions.LXDAPIException as err:
+                # The container may have been started or removed.
+                hookenv.log('cannot remove container {}: {}'.format(
+                    name, err))
+                continue
+            new_frozen_since.pop(name, None)
+            removed.append(name)
+            continue
+        if status != 'running' or not idle_window:
             continue
-        if is_running:
-            container.stop(wait=True)
-        container.delete()
+        state = data.get('state')
+        if state is None:
+            # LXD servers not supporting the full container recursion level.
+            state = client.api.containers[name].state.get().json()['metadata']
+        usage = state['cpu']['usage']
+        sample = samples.get(name)
+        if sample is None or sample['usage'] != usage:
+            new_samples[name] = {'usage': usage, 'since': now}
+            continue
+        new_samples[name] = sample
+        if now - sample['since'] >= idle_window * 60:
+            hookenv.log('freezing idle container {}'.format(name))
+            try:
+                _container_from_data(client, data).freeze(wait=True)
+            except exceptions.LXDAPIException as err:
+                # The sample is kept, so that freezing is retried later.
+                hookenv.log('cannot freeze container {}: {}'.format(
+                    name, err))
+                continue
+            frozen.append(name)
+            new_frozen_since[name] = now
+            del new_samples[name]
+    kv.set(_FROZEN_KEY, new_frozen_since)
+    kv.set(_CPU_SAMPLES_KEY, new_samples)
+    return tuple(removed), tuple(frozen)
+
+
+def _parse_time(value):
+    """Return the epoch timestamp corresponding to the given LXD time string.
+
+    LXD times are in UTC. Return 0 if the value is empty.
+    """
+    if not value:
+        return 0
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+# Define the unit key/value store keys used for storing container CPU usage
+# and the times when containers were first seen frozen.
+_CPU_SAMPLES_KEY = 'jujushell.cpu-samples'
+_FROZEN_KEY = 'jujushell.frozen-containers'
+
+
+def refill_pool(size):
+    """Make the warm pool include the given number of containers.
+
+    Pool containers are created, but not started, from the termserver image.
+    Their creation is not waited for, so that LXD completes it in the
+    background. Exceeding containers are removed, waiting for their removal,
+    so that they are not listed by subsequent operations.
+
+    Return the names of created containers as a sequence.
+    """
+    client = _lxd_client()
+    existing = _pool_containers(client)
+    for container in existing[size:]:
+        hookenv.log('removing pool container {}'.format(container.name))
+        container.delete(wait=True)
+    created = []
+    for _ in range(size - len(existing)):
+        name = POOL_PREFIX + uuid.uuid4().hex[:12]
+        hookenv.log('creating pool container {}'.format(name))
+        client.containers.create({
+            'name': name,
+            'profiles': [PROFILE_TERMSERVER, PROFILE_TERMSERVER_LIMITED],
+            'source': {'type': 'image', 'alias': IMAGE_NAME},
+        }, wait=False)
+        created.append(name)
+    return tuple(created)
+
+
+def empty_pool():
+    """Remove all warm pool containers.
+
+    Return the names of removed containers as a sequence.
+    """
+    client = _lxd_client()
+    removed = []
+    for container in _pool_containers(client):
+        hookenv.log('removing pool container {}'.format(container.name))
+        container.delete(wait=True)
+        removed.append(container.name)
     return tuple(removed)
 
 
-def service_url(config):
-    """Retrieve the jujushell service URL by looking at the given config."""
+def _pool_containers(client):
+    """Return the stopped warm pool containers as a list."""
+    return [
+        container for container in _list_containers(client)
+        if container.name.startswith(POOL_PREFIX) and
+        container.status.lower() == 'stopped'
+    ]
+
+
+def service_urls(config):
+    """Retrieve the jujushell metrics URLs by looking at the given config.
+
+    Return a list of URLs in order of preference: the plaintext metrics
+    listener on the loopback interface, if configured, comes first, so that
+    the main listener is only used if the former is not available, for
+    instance with older jujushell binaries.
+    """
+    urls = []
+    metrics_addr = config.get('metrics-addr')
+    if metrics_addr:
+        urls.append('http://{}/metrics'.format(metrics_addr))
     schema, host = 'http', 'localhost'
     dnsname = config.get('dns-name')
     if dnsname:
         schema, host = 'https', dnsname
     elif config.get('tls-cert'):
         schema = 'https'
-    return '{}://{}:{}/metrics'.format(schema, host, config['port'])
+    urls.append('{}://{}:{}/metrics'.format(schema, host, config['port']))
+    return urls
@@ -0,0 +1,340 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+"""Prometheus exporter for jujushell units.
+
+The exporter runs as a systemd service next to jujushell (see the
+jujushell-exporter.service template) and it publishes, in the Prometheus text
+format, LXD container usage and limits, ZFS storage usage, termserver image
+import durations and the warm pool depth, followed by the metrics exposed by
+the jujushell service itself. All container information is retrieved with a
+single LXD API call per scrape. Like jujushell_metrics, this module only
+depends on the standard library.
+"""
+
+import argparse
+import collections
+from http import (
+    client,
+    server,
+)
+import json
+import socket
+import subprocess
+import time
+
+import jujushell_metrics
+
+
+def main(args=None):
+    """Parse the given command line arguments and serve metrics forever."""
+    options = _parse_args(args)
+
+    class Handler(server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            content = collect(options).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', _CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            # Avoid logging every scrape.
+            pass
+
+    httpd = server.HTTPServer(('', options.port), Handler)
+    httpd.serve_forever()
+
+
+def collect(options):
+    """Collect and return all metrics as Prometheus text.
+
+    The given options include the lxd_socket, pool_prefix, zfs_pool, stats and
+    metrics attributes, as returned by the command line parser.
+    """
+    start = time.monotonic()
+    families = _Families()
+    try:
+        containers = _lxd_containers(options.lxd_socket)
+    except (OSError, ValueError):
+        families.add('lxd_up', 'gauge', 'Whether LXD can be queried.', 0)
+    else:
+        families.add('lxd_up', 'gauge', 'Whether LXD can be queried.', 1)
+        _add_container_metrics(families, containers, options.pool_prefix)
+    _add_zfs_metrics(families, options.zfs_pool)
+    _add_stats_metrics(families, options.stats)
+    service = _service_metrics(options.metrics)
+    families.add(
+        'service_up', 'gauge',
+        'Whether the jujushell service metrics can be retrieved.',
+        0 if service is None else 1)
+    families.add(
+        'exporter_scrape_seconds', 'gauge',
+        'The time spent collecting exporter metrics.',
+        time.monotonic() - start)
+    return families.format() + (service or '')
+
+
+def parse_bytes(value):
+    """Parse the given LXD size value, like "512MB" or "2GiB", as bytes.
+
+    Return None if the value is empty or it is not an absolute size, for
+    instance when a percentage is provided.
+    """
+    value = value.strip()
+    for suffix, multiplier in _SIZE_SUFFIXES:
+        if value.endswith(suffix):
+            number = value[:-len(suffix)].strip()
+            break
+    else:
+        number, multiplier = value, 1
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        return None
+
+
+def _parse_args(args):
+    """Parse the given command line arguments and return a namespace."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--lxd-socket', required=True)
+    parser.add_argument('--pool-prefix', required=True)
+    parser.add_argument('--zfs-pool', required=True)
+    parser.add_argument('--stats', required=True)
+    parser.add_argument('--metrics', required=True)
+    return parser.parse_args(args)
+
+
+def _lxd_containers(path):
+    """Return all LXD containers, including their state and config.
+
+    A single request is made to the LXD unix socket at the given path.
+    Raise an OSError or a ValueError if containers cannot be retrieved.
+    """
+    conn = _UnixHTTPConnection(path, timeout=_TIMEOUT)
+    try:
+        conn.request('GET', '/1.0/containers?recursion=2')
+        response = conn.getresponse()
+        body = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise OSError('LXD returned {}'.format(response.status))
+    return json.loads(body.decode('utf-8'))['metadata'] or []
+
+
+def _add_container_metrics(families, containers, pool_prefix):
+    """Add metrics about the given LXD containers to the given families."""
+    statuses = collections.Counter()
+    pool = 0
+    for container in containers:
+        name = container['name']
+        status = container.get('status') or 'Unknown'
+        statuses[status.lower()] += 1
+        if name.startswith(pool_prefix):
+            # Warm pool containers are created stopped, and they are not used
+            # by any session.
+            if status == 'Stopped':
+                pool += 1
+            continue
+        labels = {'container': name}
+        state = container.get('state') or {}
+        cpu = (state.get('cpu') or {}).get('usage')
+        if cpu is not None:
+            families.add(
+                'container_cpu_seconds_total', 'counter',
+                'The CPU time used by the container.', cpu / 1e9, labels)
+        memory = (state.get('memory') or {}).get('usage')
+        if memory is not None:
+            families.add(
+                'container_memory_bytes', 'gauge',
+                'The memory used by the container.', memory, labels)
+        processes = state.get('processes')
+        if processes is not None and processes >= 0:
+            families.add(
+                'container_processes', 'gauge',
+                'The number of processes running in the container.',
+                processes, labels)
+        config = container.get('expanded_config') or {}
+        _add_container_limits(families, config, labels)
+    for status, count in sorted(statuses.items()):
+        families.add(
+            'containers', 'gauge', 'The number of containers by status.',
+            count, {'status': status})
+    families.add(
+        'pool_containers', 'gauge',
+        'The number of warm pool containers ready to be used.', pool)
+
+
+def _add_container_limits(families, config, labels):
+    """Add the resource limits in the given container config to families."""
+    cpu = config.get('limits.cpu', '')
+    if cpu.isdigit():
+        families.add(
+            'container_cpu_limit', 'gauge',
+            'The number of CPU cores available to the container.',
+            int(cpu), labels)
+    memory = parse_bytes(config.get('limits.memory', ''))
+    if memory is not None:
+        families.add(
+            'container_memory_limit_bytes', 'gauge',
+            'The memory available to the container.', memory, labels)
+    processes = config.get('limits.processes', '')
+    if processes.isdigit():
+        families.add(
+            'container_processes_limit', 'gauge',
+            'The maximum number of processes in the container.',
+            int(processes), labels)
+
+
+def _add_zfs_metrics(families, pool):
+    """Add usage metrics about the ZFS storage pool with the given name."""
+    labels = {'pool': pool}
+    try:
+        output = subprocess.check_output(
+            ['zfs', 'get', '-Hp', '-o', 'value', 'used,available', pool],
+            stderr=subprocess.DEVNULL, timeout=_TIMEOUT)
+        used, available = (int(v) for v in output.decode('utf-8').split())
+    except (OSError, ValueError, subprocess.SubprocessError):
+        families.add(
+            'zfs_up', 'gauge', 'Whether ZFS usage can be retrieved.', 0,
+            labels)
+        return
+    families.add(
+        'zfs_up', 'gauge', 'Whether ZFS usage can be retrieved.', 1, labels)
+    families.add(
+        'zfs_used_bytes', 'gauge', 'The space used in the ZFS pool.',
+        used, labels)
+    families.add(
+        'zfs_available_bytes', 'gauge', 'The space available in the ZFS pool.',
+        available, labels)
+
+
+def _add_stats_metrics(families, path):
+    """Add metrics stored by the charm in the stats file at the given path."""
+    try:
+        with open(path) as stream:
+            stats = json.load(stream)
+    except (OSError, ValueError):
+        return
+    imports = stats.get('image-imports') or {}
+    for image, info in sorted(imports.items()):
+        labels = {'image': image}
+        families.add(
+            'image_import_seconds', 'gauge',
+            'The time spent importing the termserver image.',
+            info['seconds'], labels)
+        families.add(
+            'image_import_timestamp_seconds', 'gauge',
+            'When the termserver image was last imported.',
+            info['time'], labels)
+
+
+def _service_metrics(path):
+    """Return the metrics text exposed by the jujushell service.
+
+    The service URLs are retrieved from the metrics file at the given path.
+    Return None if the metrics cannot be retrieved.
+    """
+    try:
+        urls, _ = jujushell_metrics.load(path)
+        text = jujushell_metrics.fetch_any(urls, timeout=_TIMEOUT)
+    except (OSError, ValueError, KeyError):
+        return None
+    return text if text.endswith('\n') or not text else text + '\n'
+
+
+class _Families(object):
+    """A collection of Prometheus metric families."""
+
+    def __init__(self):
+        self._families = collections.OrderedDict()
+
+    def add(self, name, kind, description, value, labels=None):
+        """Add a sample with the given value and labels to a family."""
+        family = self._families.setdefault(
+            _PREFIX + name, (kind, description, []))
+        family[2].append((labels or {}, value))
+
+    def format(self):
+        """Return the families in the Prometheus text format."""
+        lines = []
+        for name, (kind, description, samples) in self._families.items():
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, _escape(str(value)))
+        for key, value in sorted(labels.items())) + '}'
+
+
+def _escape(value):
+    return value.replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _UnixHTTPConnection(client.HTTPConnection):
+    """An HTTP connection over a unix socket."""
+
+    def __init__(self, path, timeout):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self._path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+# Define the content type of exposed metrics.
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Define the prefix used for all exporter metrics.
+_PREFIX = 'jujushell_'
+# Define the LXD size suffixes and their multipliers. Longer suffixes come
+# first so that, for instance, "MiB" is not parsed as "B".
+_SIZE_SUFFIXES = (
+    ('KiB', 1024),
+    ('MiB', 1024 ** 2),
+    ('GiB', 1024 ** 3),
+    ('TiB', 1024 ** 4),
+    ('PiB', 1024 ** 5),
+    ('EiB', 1024 ** 6),
+    ('kB', 1000),
+    ('MB', 1000 ** 2),
+    ('GB', 1000 ** 3),
+    ('TB', 1000 ** 4),
+    ('PB', 1000 ** 5),
+    ('EB', 1000 ** 6),
+    ('B', 1),
+)
+# Define the timeout in seconds for each operation performed while scraping.
+_TIMEOUT = 10
+
+
+if __name__ == '__main__':
+    main()
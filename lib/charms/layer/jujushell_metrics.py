@@ -0,0 +1,329 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+"""Collect jujushell metrics and add them to Juju.
+
+This module is used by the collect-metrics hook, which runs every few
+minutes. For this reason it only depends on the standard library, and it
+must not import the jujushell layer module, charm helpers or YAML parsers:
+everything it needs is precomputed by jujushell.build_config.
+"""
+
+from http import client
+import json
+import os
+import re
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+
+def main(path):
+    """Add to Juju the metrics described by the JSON file at the given path.
+
+    The metrics are retrieved within a deadline, so that an overloaded
+    service never stalls the hook. If they cannot be retrieved, the last
+    samples successfully retrieved, stored in a cache file next to the given
+    one, are reported instead. In both cases the "metrics_staleness" metric,
+    if requested, reports how old the samples are, in seconds.
+    """
+    urls, names = load(path)
+    cache = os.path.join(os.path.dirname(path), _CACHE_NAME)
+    now = time.time()
+    try:
+        samples = retrieve(
+            urls, [name for name in names if name != _STALENESS],
+            timeout=_DEADLINE)
+    except OSError as err:
+        print(err, file=sys.stderr)
+        samples, collected = _load_cache(cache)
+        if now - collected > _MAX_STALENESS:
+            samples = []
+    else:
+        collected = now
+        _save_cache(cache, samples, collected)
+    if _STALENESS in names and collected:
+        samples.append((_STALENESS, max(now - collected, 0)))
+    add(samples)
+
+
+def load(path):
+    """Load the metrics file at the given path.
+
+    Return the jujushell metrics URLs, in order of preference, and the names
+    of the metrics to collect.
+    """
+    with open(path) as stream:
+        info = json.load(stream)
+    return tuple(info['urls']), tuple(info['metrics'])
+
+
+def retrieve(urls, names, timeout=30):
+    """Retrieve and return samples for the given metric names.
+
+    Metrics are retrieved from the first of the given URLs that responds.
+
+    Samples are returned as a list of (name, value) tuples. Each metric is
+    reported using the first sample whose name includes the metric name: for
+    instance, "requests_count" matches the "jujushell_requests_count" sample.
+    Metric names ending with "_p" followed by a number are percentiles: for
+    instance, "requests_duration_p95" is the 95th percentile estimated from
+    the buckets of the histogram including "requests_duration" in its name.
+    Percentiles are not reported if the histogram has no observations.
+    Raise an OSError if the metrics cannot be retrieved.
+    """
+    if not names:
+        return []
+    text = fetch_any(urls, timeout=timeout)
+    samples = list(parse(text))
+    results = []
+    for name in names:
+        match = _PERCENTILE.match(name)
+        if match:
+            base, percentile = match.groups()
+            value = quantile(
+                int(percentile) / 100, _buckets(samples, base))
+            if value is not None:
+                results.append((name, value))
+            continue
+        for sample in samples:
+            if name in sample[0]:
+                results.append((name, sample[2]))
+                samples.remove(sample)
+                break
+    return results
+
+
+def quantile(q, buckets):
+    """Estimate the q quantile (0 <= q <= 1) from the given histogram buckets.
+
+    Buckets are provided as a sequence of (upper bound, cumulative count)
+    tuples. As in the Prometheus histogram_quantile function, values are
+    assumed to be linearly distributed within each bucket, and the upper
+    bound of the highest finite bucket is returned for observations falling
+    in the +Inf bucket. Return None if there are no observations.
+    """
+    buckets = sorted(buckets)
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            break
+        lower, below = upper, count
+    if upper == float('inf'):
+        return lower
+    if count == below:
+        return upper
+    return lower + (upper - lower) * (rank - below) / (count - below)
+
+
+def _buckets(samples, base):
+    """Return the histogram buckets for the given base name from samples.
+
+    Buckets with the same bound and different labels, for instance one
+    for each request method, are merged.
+    """
+    counts = {}
+    for name, labels, value in samples:
+        if base not in name or not name.endswith('_bucket'):
+            continue
+        bound = dict(_LABEL.findall(labels)).get('le')
+        try:
+            bound = float(bound)
+        except (TypeError, ValueError):
+            continue
+        counts[bound] = counts.get(bound, 0) + value
+    return list(counts.items())
+
+
+# Define the regular expressions used to parse percentile metric names and
+# the labels of samples.
+_PERCENTILE = re.compile(r'^(.+)_p(\d{1,2})$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def fetch_any(urls, timeout=30):
+    """Fetch and return the Prometheus metrics text from one of the URLs.
+
+    URLs are tried in order, and all attempts must complete within the given
+    timeout in seconds. This way the service main listener can be used when
+    the loopback metrics listener is not available.
+    Raise an OSError with the last error if metrics cannot be retrieved.
+    """
+    deadline = time.monotonic() + timeout
+    error = OSError('no metrics URLs')
+    for url in urls:
+        try:
+            return fetch(url, timeout=max(deadline - time.monotonic(), 0))
+        except OSError as err:
+            error = err
+    raise error
+
+
+def fetch(url, timeout=30):
+    """Fetch and return the Prometheus metrics text from the given URL.
+
+    The whole request, including connecting and reading the response, must
+    complete within the given timeout in seconds. Connections are kept open
+    and reused by subsequent calls for the same host.
+    Raise an OSError if the metrics cannot be retrieved.
+    """
+    deadline = time.monotonic() + timeout
+    target = urllib.parse.urlsplit(url)
+    key = (target.scheme, target.netloc)
+    conn = _connections.pop(key, None)
+    while True:
+        reused = conn is not None
+        if not reused:
+            conn = _connect(target)
+        try:
+            text = _get(conn, target, deadline)
+        except (OSError, client.HTTPException) as err:
+            conn.close()
+            # The server may have closed an idle connection: try again with a
+            # new one, if there is still time.
+            if reused and time.monotonic() < deadline:
+                conn = None
+                continue
+            raise OSError(
+                'cannot retrieve metrics from {}: {}'.format(url, err))
+        _connections[key] = conn
+        return text
+
+
+def _connect(target):
+    """Return a new HTTP connection for the given split URL."""
+    if target.scheme == 'https':
+        # The service is reached locally, and it may use a self signed cert.
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return client.HTTPSConnection(
+            target.hostname, target.port, context=context)
+    return client.HTTPConnection(target.hostname, target.port)
+
+
+def _get(conn, target, deadline):
+    """Send a GET request using the given connection and return the body.
+
+    Raise an OSError or an http.client.HTTPException if the request fails or
+    if the deadline is exceeded.
+    """
+    conn.timeout = _remaining(deadline)
+    if conn.sock is not None:
+        conn.sock.settimeout(conn.timeout)
+    path = target.path or '/'
+    if target.query:
+        path += '?' + target.query
+    conn.request('GET', path)
+    sock = conn.sock
+    sock.settimeout(_remaining(deadline))
+    response = conn.getresponse()
+    chunks = []
+    while True:
+        remaining = _remaining(deadline)
+        # The connection is closed after the response headers are read if
+        # the server does not support keep-alive.
+        if conn.sock is sock:
+            sock.settimeout(remaining)
+        chunk = response.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    if response.status != 200:
+        raise OSError('unexpected status {}'.format(response.status))
+    return b''.join(chunks).decode('utf-8')
+
+
+def _remaining(deadline):
+    """Return the seconds left before the given deadline.
+
+    Raise a TimeoutError if the deadline has been exceeded.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError('deadline exceeded')
+    return remaining
+
+
+def _load_cache(path):
+    """Return the samples stored at the given path and when they were taken.
+
+    Return no samples, collected at time 0, if the cache is not available.
+    """
+    try:
+        with open(path) as stream:
+            cache = json.load(stream)
+        return [tuple(sample) for sample in cache['samples']], cache['time']
+    except (OSError, ValueError, KeyError, TypeError):
+        return [], 0
+
+
+def _save_cache(path, samples, collected):
+    """Atomically store the given samples and collection time at path.
+
+    Errors are ignored, as the cache is only used as a fallback.
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump({'samples': samples, 'time': collected}, stream)
+        os.rename(tmp, path)
+    except OSError:
+        os.remove(tmp)
+
+
+# Define open connections to metrics endpoints, keyed by scheme and host.
+_connections = {}
+# Define the size of chunks read from responses.
+_CHUNK_SIZE = 64 * 1024
+# Define the name of the cache file, the time in seconds for retrieving
+# metrics in the hook, and the time in seconds after which cached samples
+# are no longer reported.
+_CACHE_NAME = 'metrics-cache.json'
+_DEADLINE = 10
+_MAX_STALENESS = 60 * 60
+# Define the name of the metric reporting how old samples are.
+_STALENESS = 'metrics_staleness'
+
+
+def parse(text):
+    """Parse the given Prometheus text exposition format.
+
+    Return an iterator of (name, labels, value) tuples, in which labels is
+    the text between braces, if any. Samples with invalid values are ignored.
+    """
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        labels = ''
+        brace = line.find('{')
+        if brace != -1:
+            end = line.rfind('}')
+            name, labels, rest = line[:brace], line[brace+1:end], line[end+1:]
+        else:
+            name, _, rest = line.partition(' ')
+        fields = rest.split()
+        if not fields:
+            continue
+        try:
+            value = float(fields[0])
+        except ValueError:
+            continue
+        yield name.strip(), labels, value
+
+
+def add(samples):
+    """Add the given (name, value) samples as metrics to Juju."""
+    if samples:
+        subprocess.check_call(['add-metric'] + [
+            '{}={}'.format(name, value) for name, value in samples])
@@ -27,7 +27,10 @@ def install():
     # https://github.com/lxc/pylxd/issues/232 in xenial.
     # TODO(frankban) We can remove this in favor of installing via apt when
     # xenial is updated with the fixed package.
-    jujushell.call('pip', 'install', 'pylxd==2.2.6')
+    # The cryptography package, used for generating self signed certificates,
+    # is installed for the same reason.
+    jujushell.call(
+        'pip', 'install', 'pylxd==2.2.6', 'cryptography', timeout=600)
     set_flag('jujushell.install')
 
 
@@ -35,10 +38,33 @@ def install():
 def upgrade_charm():
     clear_flag('jujushell.resource.available.jujushell')
     clear_flag('jujushell.resource.available.termserver')
+    clear_flag('jujushell.resource.available.limited-termserver')
+    clear_flag('jujushell.termserver.available')
     clear_flag('jujushell.lxd.image.imported.termserver')
+    clear_flag('jujushell.lxd.image.imported.termserver-full')
+    clear_flag('jujushell.lxd.image.imported.termserver-limited')
+    # Render the systemd services again, as they may have been changed.
+    clear_flag('jujushell.service.installed')
+    clear_flag('jujushell.exporter.installed')
     set_flag('jujushell.restart')
 
 
+@hook('update-status')
+def update_status():
+    # Refill the warm pool, as containers are claimed while sessions start.
+    clear_flag('jujushell.pool.ready')
+    set_flag('jujushell.reap')
+
+
+@when('jujushell.reap')
+@when('jujushell.lxd.configured')
+def reap_containers():
+    config = hookenv.config()
+    jujushell.reap_containers(
+        config['reaper-stopped-age'], config['reaper-idle-window'])
+    clear_flag('jujushell.reap')
+
+
 @hook('start')
 def start():
     set_flag('jujushell.start')
@@ -59,32 +85,52 @@ def install_zfsutils():
 @when('jujushell.install')
 @when_not('jujushell.resource.available.jujushell')
 def install_jujushell():
+    fetch_resources()
     hookenv.status_set('maintenance', 'fetching jujushell')
     path = jujushell.jujushell_path()
     try:
         jujushell.save_resource('jujushell', path)
         os.chmod(path, 0o775)
         # Allow for running jujushell on privileged ports.
-        jujushell.call('setcap', 'CAP_NET_BIND_SERVICE=+eip', path)
+        jujushell.call(
+            'setcap', 'CAP_NET_BIND_SERVICE=+eip', path, timeout=60)
     except OSError as err:
         hookenv.status_set(
             'blocked', 'jujushell resource not available: {}'.format(err))
 
 
 @when('jujushell.install')
-@when_not('jujushell.resource.available.termserver')
+@when_not('jujushell.termserver.available')
 def install_termserver():
+    fetch_resources()
     hookenv.status_set('maintenance', 'fetching termserver')
-    try:
-        # TODO for now, we save both termserver resources. In the future, this
-        # may be streamlined to only save one at a time as needed.
-        jujushell.save_resource(
-            'termserver', jujushell.termserver_path())
-        jujushell.save_resource(
-            'limited-termserver', jujushell.termserver_path(limited=True))
-    except OSError as err:
-        hookenv.status_set(
-            'blocked', 'termserver resource not available: {}'.format(err))
+    # Only retrieve the termserver image selected by the limit-termserver
+    # option. The other one is retrieved when the option changes.
+    limited = hookenv.config()['limit-termserver']
+    name = jujushell.termserver_resource(limited=limited)
+    if not is_flag_set('jujushell.resource.available.{}'.format(name)):
+        try:
+            jujushell.save_resource(
+                name, jujushell.termserver_path(limited=limited))
+        except OSError as err:
+            hookenv.status_set(
+                'blocked',
+                'termserver resource not available: {}'.format(err))
+            return
+    set_flag('jujushell.termserver.available')
+
+
+def fetch_resources():
+    """Start retrieving the resources that are needed and not available."""
+    limited = hookenv.config()['limit-termserver']
+    resources = (
+        ('jujushell', jujushell.jujushell_path()),
+        (jujushell.termserver_resource(limited=limited),
+         jujushell.termserver_path(limited=limited)),
+    )
+    for name, path in resources:
+        if not is_flag_set('jujushell.resource.available.{}'.format(name)):
+            jujushell.fetch_resource(name, path)
 
 
 @when('jujushell.resource.available.jujushell')
@@ -93,6 +139,14 @@ def install_service():
     jujushell.install_service()
 
 
+@when('jujushell.service.installed')
+@when('jujushell.lxd.configured')
+@when('jujushell.start')
+@when_not('jujushell.exporter.installed')
+def install_exporter():
+    jujushell.install_exporter(hookenv.config()['exporter-port'])
+
+
 @when('jujushell.install')
 @when('apt.installed.zfsutils-linux')
 @only_once
@@ -103,14 +157,73 @@ def setup_lxd():
 
 
 @when('jujushell.lxd.configured')
-@when('jujushell.resource.available.termserver')
-@when('jujushell.resource.available.limited-termserver')
+@when('jujushell.termserver.available')
 @when_not('jujushell.lxd.image.imported.termserver')
 def import_image():
+    config = hookenv.config()
+    limited = config['limit-termserver']
+    variant = jujushell.image_variant(limited=limited)
     hookenv.status_set('maintenance', 'importing termserver images')
-    limited = hookenv.config()['limit-termserver']
     jujushell.import_lxd_image(
-        'termserver', jujushell.termserver_path(limited=limited))
+        variant, jujushell.termserver_path(limited=limited))
+    switch_image(variant)
+    if is_flag_set('jujushell.running'):
+        hookenv.status_set('active', 'jujushell running')
+
+
+@when('jujushell.running')
+@when('jujushell.lxd.image.imported.termserver')
+def prepare_image():
+    # If requested, also import the termserver image that is not in use, so
+    # that changing the limit-termserver option only requires switching the
+    # image alias. The image is imported in the background, and this handler
+    # completes the import in a later hook. Juju resources can only be
+    # retrieved by hooks, so the image is downloaded when the hook exits.
+    config = hookenv.config()
+    if not config['prepare-standby-image']:
+        return
+    limited = not config['limit-termserver']
+    variant = jujushell.image_variant(limited=limited)
+    if is_flag_set('jujushell.lxd.image.imported.{}'.format(variant)):
+        return
+    name = jujushell.termserver_resource(limited=limited)
+    path = jujushell.termserver_path(limited=limited)
+    if not is_flag_set('jujushell.resource.available.{}'.format(name)):
+        # The image is imported in a later hook, once it is retrieved.
+        jujushell.save_resource_in_background(name, path)
+        return
+    hookenv.log('preparing termserver image {}'.format(variant))
+    if jujushell.import_lxd_image_in_background(variant, path):
+        # The image is now stored in LXD.
+        jujushell.remove_resource(name, path)
+
+
+def switch_image(variant):
+    """Make the termserver image alias refer to the given image variant."""
+    if not jujushell.switch_lxd_image('termserver', variant):
+        return
+    # Pool containers are based on the previous image: remove them before
+    # collecting old images.
+    rebuild_pool()
+    keep = hookenv.config()['image-retention']
+    if keep > 0:
+        hookenv.log('removing old termserver images')
+        jujushell.collect_lxd_images(keep)
+
+
+@when('jujushell.pool.stale')
+def rebuild_pool():
+    jujushell.empty_pool()
+    clear_flag('jujushell.pool.stale')
+    clear_flag('jujushell.pool.ready')
+
+
+@when('jujushell.lxd.image.imported.termserver')
+@when_not('jujushell.pool.stale')
+@when_not('jujushell.pool.ready')
+def fill_pool():
+    jujushell.refill_pool(hookenv.config()['warm-pool-size'])
+    set_flag('jujushell.pool.ready')
 
 
 @when('jujushell.lxd.image.imported.termserver')
@@ -123,6 +236,7 @@ def start_service():
     host.service_start('jujushell')
     hookenv.status_set('active', 'jujushell running')
     clear_flag('jujushell.restart')
+    clear_flag('jujushell.reload')
     set_flag('jujushell.running')
 
 
@@ -135,6 +249,21 @@ def restart_service():
     host.service_restart('jujushell')
     hookenv.status_set('active', 'jujushell running')
     clear_flag('jujushell.restart')
+    clear_flag('jujushell.reload')
+
+
+@when('jujushell.running')
+@when('jujushell.reload')
+@when_not('jujushell.restart')
+def reload_service():
+    # Ask the service to reload its configuration file, so that live sessions
+    # are preserved. Options requiring a new listener, like the port or TLS
+    # options, require a restart instead: see jujushell.config_actions.
+    # The reload signal terminates services not supporting it: in that case
+    # systemd starts the service again, as configured in its unit.
+    hookenv.log('reloading the jujushell service')
+    host.service_reload('jujushell', restart_on_failure=True)
+    clear_flag('jujushell.reload')
 
 
 @when('jujushell.running')
@@ -144,14 +273,62 @@ def stop_service():
     clear_flag('jujushell.running')
 
 
+@when('jujushell.exporter.installed')
+@when_not('jujushell.start')
+def remove_exporter():
+    # The exporter service runs code from the charm directory, which is
+    # removed with the unit.
+    jujushell.install_exporter(0)
+    clear_flag('jujushell.exporter.installed')
+
+
 @when('config.changed')
 def config_changed():
     config = hookenv.config()
-    jujushell.build_config(config)
+    actions = jujushell.config_actions(
+        key for key in config if config.changed(key))
+    hookenv.log('config changed: running {}'.format(sorted(actions)))
+    if 'config' in actions and not jujushell.build_config(config):
+        # The service only needs to be restarted or reloaded when its config
+        # file actually changed.
+        actions -= {'restart', 'reload'}
     if is_flag_set('jujushell.lxd.configured'):
-        jujushell.update_lxc_quotas(config)
-        clear_flag('jujushell.lxd.image.imported.termserver')
-    set_flag('jujushell.restart')
+        if 'quotas' in actions and jujushell.update_lxc_quotas(config):
+            # Pool containers must be created again with the new profile.
+            set_flag('jujushell.pool.stale')
+        if 'image' in actions:
+            change_image(config['limit-termserver'])
+    elif 'image' in actions:
+        # The selected termserver image may need to be retrieved.
+        clear_flag('jujushell.termserver.available')
+    if 'pool' in actions:
+        clear_flag('jujushell.pool.ready')
+    if 'exporter' in actions:
+        clear_flag('jujushell.exporter.installed')
+        # Prometheus must scrape a different port.
+        clear_flag('prometheus.configured')
+    if 'restart' in actions:
+        set_flag('jujushell.restart')
+    elif 'reload' in actions:
+        set_flag('jujushell.reload')
+
+
+def change_image(limited):
+    """Switch to the given termserver image variant.
+
+    If the image has been already imported, only the image alias is changed.
+    Otherwise, the image is retrieved and imported.
+    """
+    variant = jujushell.image_variant(limited=limited)
+    if is_flag_set('jujushell.lxd.image.imported.{}'.format(variant)):
+        try:
+            switch_image(variant)
+            return
+        except ValueError as err:
+            hookenv.log('cannot switch image: {}'.format(err))
+            clear_flag('jujushell.lxd.image.imported.{}'.format(variant))
+    clear_flag('jujushell.termserver.available')
+    clear_flag('jujushell.lxd.image.imported.termserver')
 
 
 @when('website.available')
@@ -172,8 +349,7 @@ def website_port_changed(website):
 @when('prometheus.available')
 @when_not('prometheus.configured')
 def prometheus_available(prometheus):
-    config = hookenv.config()
-    prometheus.configure(port=jujushell.get_ports(config)[0])
+    prometheus.configure(port=jujushell.prometheus_port(hookenv.config()))
     set_flag('prometheus.configured')
 
 
@@ -2,17 +2,26 @@
 # Licensed under the AGPLv3, see LICENCE file for details.
 
 import base64
+import contextlib
+import hashlib
+import json
 import os
 import shutil
 import sys
 import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
 from unittest.mock import (
     call,
+    MagicMock,
     Mock,
     patch,
 )
 
+from charmhelpers.core import unitdata
+from pylxd import exceptions
 import yaml
 
 _root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -24,6 +33,18 @@ sys.path.insert(0, _layer)
 import jujushell  # noqa: E402
 
 
+def list_containers(client, name=None):
+    """Return containers from the containers.all method of the given client.
+
+    This is used in place of jujushell._list_containers, which relies on the
+    LXD REST API, so that tests can provide mock containers.
+    """
+    return [
+        container for container in client.containers.all()
+        if not name or container.name == name
+    ]
+
+
 @patch('charmhelpers.core.hookenv.log')
 class TestCall(unittest.TestCase):
 
@@ -72,30 +93,285 @@ class TestCall(unittest.TestCase):
             call("running the following: 'no-such-command'"),
         ])
 
+    def test_timeout(self, mock_log):
+        # An OSError is raised if the command does not complete in time.
+        with self.assertRaises(OSError) as ctx:
+            jujushell.call('sh', '-c', 'echo start; sleep 10', timeout=0.5)
+        expected_error = (
+            'command "sh -c \'echo start; sleep 10\'" timed out after 0.5 '
+            'seconds: \'start\\n\'')
+        self.assertEqual(expected_error, str(ctx.exception))
+        mock_log.assert_called_with(expected_error)
+
+    def test_output_limit(self, mock_log):
+        # Only the last part of long outputs is retained.
+        with patch('jujushell._Output.limit', 10):
+            with self.assertRaises(OSError) as ctx:
+                jujushell.call(
+                    'sh', '-c', 'echo these; echo are the; echo voyages; '
+                    'echo 0123456789abcdef; exit 1')
+        self.assertTrue(str(ctx.exception).endswith(
+            "failed with retcode 1: '[...]\\n789abcdef\\n'"))
+
+    def test_concurrently(self, mock_log):
+        # Multiple commands can be run concurrently.
+        start = time.monotonic()
+        jujushell.call_concurrently([
+            ('sleep', '0.5'),
+            ('sleep', '0.5'),
+            ('sleep', '0.5'),
+        ], timeout=5)
+        self.assertLess(time.monotonic() - start, 1.4)
+        self.assertEqual(6, mock_log.call_count)
+
+    def test_concurrently_failure(self, mock_log):
+        # An OSError is raised after all commands complete if any fail.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'file')
+        with self.assertRaises(OSError) as ctx:
+            jujushell.call_concurrently([
+                ('ls', 'no-such-file'),
+                ('no-such-command',),
+                ('sh', '-c', 'sleep 0.2; touch ' + path),
+            ])
+        expected_error = 'command \'ls no-such-file\' failed with retcode 2:'
+        self.assertTrue(str(ctx.exception).startswith(expected_error))
+        self.assertTrue(os.path.exists(path))
+
+    def test_concurrently_timeout(self, mock_log):
+        # All commands must complete in the given timeout.
+        start = time.monotonic()
+        with self.assertRaises(OSError) as ctx:
+            jujushell.call_concurrently([
+                ('true',),
+                ('sleep', '10'),
+            ], timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(str(ctx.exception).startswith(
+            "command 'sleep 10' timed out after"))
+
+    def test_timeout_kills_children(self, mock_log):
+        # Children of the command are killed on timeout.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'pid')
+        with self.assertRaises(OSError):
+            jujushell.call(
+                'sleep 37 & echo $! > {}; wait'.format(path), shell=True,
+                timeout=0.5)
+        with open(path) as stream:
+            pid = int(stream.read())
+        self.assertFalse(is_running(pid))
+
+    def test_long_line(self, mock_log):
+        # Lines longer than the output limit are read in chunks.
+        with patch('jujushell._Output.limit', 10):
+            with self.assertRaises(OSError) as ctx:
+                jujushell.call(
+                    'sh', '-c', 'printf 0123456789abcdefghijklmnopqrstu; '
+                    'exit 1')
+        self.assertTrue(str(ctx.exception).endswith(
+            "failed with retcode 1: '[...]\\nlmnopqrstu'"))
+
+
+def is_running(pid, timeout=5):
+    """Report whether the process with the given pid is still running.
+
+    Wait up to the given timeout, in seconds, for the process to terminate.
+    Zombie processes are not considered to be running.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as stream:
+                state = stream.read().rsplit(')', 1)[1].split()[0]
+        except FileNotFoundError:
+            return False
+        if state in ('Z', 'X'):
+            return False
+        time.sleep(0.05)
+    return True
+
 
+@patch('charmhelpers.core.hookenv.log')
+@patch('charmhelpers.core.hookenv.status_set')
 class TestUpdateLXCQuotas(unittest.TestCase):
 
-    def test_update_lxc_quotas(self):
-        cfg = {
-            'lxc-quota-cpu-cores': 1,
-            'lxc-quota-cpu-allowance': '100%',
-            'lxc-quota-ram': '256MB',
-            'lxc-quota-processes': 100,
-        }
-        with patch('jujushell.call') as mock_call:
+    cfg = {
+        'lxc-quota-cpu-cores': 1,
+        'lxc-quota-cpu-allowance': '100%',
+        'lxc-quota-ram': '256MB',
+        'lxc-quota-processes': 100,
+    }
+
+    def test_update_lxc_quotas(self, mock_status_set, mock_log):
+        # All quotas are updated at once.
+        with self.patch_lxd_client({'user.key': 'value'}) as client:
+            changed = jujushell.update_lxc_quotas(self.cfg)
+        self.assertTrue(changed)
+        client.profiles.get.assert_called_once_with(
+            jujushell.PROFILE_TERMSERVER)
+        profile = client.profiles.get(jujushell.PROFILE_TERMSERVER)
+        self.assertEqual({
+            'limits.cpu': '1',
+            'limits.cpu.allowance': '100%',
+            'limits.memory': '256MB',
+            'limits.processes': '100',
+            'user.key': 'value',
+        }, profile.config)
+        profile.save.assert_called_once_with(wait=True)
+        mock_status_set.assert_called_once_with(
+            'maintenance', 'updating LXC quotas')
+
+    def test_update_lxc_quotas_changed(self, mock_status_set, mock_log):
+        # Only changed quotas are updated.
+        with self.patch_lxd_client({
+            'limits.cpu': '1',
+            'limits.cpu.allowance': '100%',
+            'limits.memory': '128MB',
+            'limits.processes': '100',
+        }) as client:
+            changed = jujushell.update_lxc_quotas(self.cfg)
+        self.assertTrue(changed)
+        profile = client.profiles.get(jujushell.PROFILE_TERMSERVER)
+        self.assertEqual('256MB', profile.config['limits.memory'])
+        profile.save.assert_called_once_with(wait=True)
+
+    def test_update_lxc_quotas_unchanged(self, mock_status_set, mock_log):
+        # The profile is not saved if quotas are already up to date.
+        with self.patch_lxd_client({
+            'limits.cpu': '1',
+            'limits.cpu.allowance': '100%',
+            'limits.memory': '256MB',
+            'limits.processes': '100',
+        }) as client:
+            changed = jujushell.update_lxc_quotas(self.cfg)
+        self.assertFalse(changed)
+        profile = client.profiles.get(jujushell.PROFILE_TERMSERVER)
+        self.assertFalse(profile.save.called)
+        self.assertFalse(mock_status_set.called)
+        mock_log.assert_called_once_with('LXC quotas are already up to date')
+
+    def test_update_lxc_quotas_empty(self, mock_status_set, mock_log):
+        # Empty quotas are removed from the profile.
+        cfg = dict(self.cfg, **{'lxc-quota-ram': ''})
+        with self.patch_lxd_client({
+            'limits.cpu': '1',
+            'limits.cpu.allowance': '100%',
+            'limits.memory': '256MB',
+            'limits.processes': '100',
+        }) as client:
+            changed = jujushell.update_lxc_quotas(cfg)
+        self.assertTrue(changed)
+        profile = client.profiles.get(jujushell.PROFILE_TERMSERVER)
+        self.assertEqual({
+            'limits.cpu': '1',
+            'limits.cpu.allowance': '100%',
+            'limits.processes': '100',
+        }, profile.config)
+        profile.save.assert_called_once_with(wait=True)
+
+    def test_update_lxc_quotas_empty_unchanged(
+            self, mock_status_set, mock_log):
+        # The profile is not saved if empty quotas are already removed.
+        cfg = dict(self.cfg, **{'lxc-quota-ram': ''})
+        with self.patch_lxd_client({
+            'limits.cpu': '1',
+            'limits.cpu.allowance': '100%',
+            'limits.processes': '100',
+        }) as client:
+            changed = jujushell.update_lxc_quotas(cfg)
+        self.assertFalse(changed)
+        profile = client.profiles.get(jujushell.PROFILE_TERMSERVER)
+        self.assertFalse(profile.save.called)
+
+    def test_tiers_created(self, mock_status_set, mock_log):
+        # Quota tier profiles are created.
+        cfg = dict(self.cfg, **{
+            'lxc-quota-tiers': (
+                'heavy: {cpu-cores: 4, ram: 4GB, processes: 1000}\n'
+                'casual: {cpu-allowance: 25%}\n'),
+        })
+        with self.patch_lxd_client({}) as client:
+            jujushell.update_lxc_quotas(cfg)
+        self.assertEqual([
+            call('termserver-tier-casual', config={
+                'limits.cpu.allowance': '25%',
+            }),
+            call('termserver-tier-heavy', config={
+                'limits.cpu': '4',
+                'limits.memory': '4GB',
+                'limits.processes': '1000',
+            }),
+        ], client.profiles.create.call_args_list)
+
+    def test_tiers_updated(self, mock_status_set, mock_log):
+        # Quota tier profiles are updated if their limits changed.
+        cfg = dict(self.cfg, **{
+            'lxc-quota-tiers': 'heavy: {cpu-cores: 4}\nlight: {cpu-cores: 1}',
+        })
+        heavy = self.make_profile('termserver-tier-heavy', {'limits.cpu': '2'})
+        light = self.make_profile('termserver-tier-light', {'limits.cpu': '1'})
+        with self.patch_lxd_client({}, [heavy, light]) as client:
             jujushell.update_lxc_quotas(cfg)
-        expected_calls = [
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.cpu', '1'),
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.cpu.allowance', '100%'),
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.memory', '256MB'),
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.processes', '100'),
+        self.assertFalse(client.profiles.create.called)
+        self.assertEqual({'limits.cpu': '4'}, heavy.config)
+        heavy.save.assert_called_once_with(wait=True)
+        self.assertFalse(light.save.called)
+
+    def test_tiers_removed(self, mock_status_set, mock_log):
+        # Profiles of tiers no longer defined are removed, when possible.
+        response = Mock()
+        response.json.return_value = {'error': 'profile in use'}
+        heavy = self.make_profile('termserver-tier-heavy', {})
+        heavy.delete.side_effect = exceptions.LXDAPIException(response)
+        light = self.make_profile('termserver-tier-light', {})
+        other = self.make_profile('other', {})
+        with self.patch_lxd_client({}, [heavy, light, other]):
+            jujushell.update_lxc_quotas(self.cfg)
+        heavy.delete.assert_called_once_with()
+        light.delete.assert_called_once_with()
+        self.assertFalse(other.delete.called)
+        mock_log.assert_any_call(
+            'cannot remove profile termserver-tier-heavy: profile in use')
+
+    def test_invalid_tiers(self, mock_status_set, mock_log):
+        # A ValueError is raised if quota tiers are not valid.
+        tests = [
+            ('heavy: [', 'invalid LXC quota tiers: '),
+            ('- heavy', 'invalid LXC quota tiers: not a mapping'),
+            ('Heavy!: {cpu-cores: 4}', "invalid LXC quota tier 'Heavy!'"),
+            ('heavy: 4', "invalid LXC quota tier 'heavy'"),
+            ('heavy: {gpus: 4}',
+             "invalid quota 'gpus' in LXC quota tier 'heavy'"),
         ]
-        mock_call.assert_has_calls(expected_calls)
-        self.assertEqual(mock_call.call_count, len(expected_calls))
+        for tiers, want_error in tests:
+            with self.subTest(tiers):
+                cfg = dict(self.cfg, **{'lxc-quota-tiers': tiers})
+                with self.patch_lxd_client({}):
+                    with self.assertRaises(ValueError) as ctx:
+                        jujushell.update_lxc_quotas(cfg)
+                self.assertTrue(str(ctx.exception).startswith(want_error))
+
+    def make_profile(self, name, config):
+        """Make and return a mock LXD profile."""
+        profile = Mock(config=config)
+        profile.name = name
+        return profile
+
+    def patch_lxd_client(self, config, profiles=()):
+        """Patch the LXD client so that profiles have the given config.
+
+        Other profiles, including quota tier ones, can also be provided.
+        """
+        client = Mock()
+        termserver = self.make_profile(jujushell.PROFILE_TERMSERVER, config)
+        profiles = {profile.name: profile for profile in profiles}
+        profiles[termserver.name] = termserver
+        client.profiles.all.return_value = list(profiles.values())
+        client.profiles.get.side_effect = profiles.get
+        return patch_lxd_client(client)
 
 
 class TestTermserverPath(unittest.TestCase):
@@ -109,6 +385,70 @@ class TestTermserverPath(unittest.TestCase):
             '/var/tmp/termserver-limited.tar.gz')
 
 
+class TestConfigActions(unittest.TestCase):
+
+    tests = [{
+        'about': 'no changes',
+        'keys': [],
+        'want_actions': set(),
+    }, {
+        'about': 'hot reloadable options',
+        'keys': ['allowed-users', 'welcome-message'],
+        'want_actions': {'config', 'reload'},
+    }, {
+        'about': 'listener options',
+        'keys': ['log-level', 'port'],
+        'want_actions': {'config', 'reload', 'restart'},
+    }, {
+        'about': 'quotas',
+        'keys': ['lxc-quota-ram', 'lxc-quota-processes'],
+        'want_actions': {'quotas'},
+    }, {
+        'about': 'image',
+        'keys': ['limit-termserver'],
+        'want_actions': {'image'},
+    }, {
+        'about': 'warm pool',
+        'keys': ['warm-pool-size'],
+        'want_actions': {'config', 'reload', 'pool'},
+    }, {
+        'about': 'quota tiers',
+        'keys': ['lxc-quota-tiers'],
+        'want_actions': {'config', 'reload', 'quotas'},
+    }, {
+        'about': 'quota tier users',
+        'keys': ['lxc-quota-tier-users'],
+        'want_actions': {'config', 'reload'},
+    }, {
+        'about': 'exporter',
+        'keys': ['exporter-port'],
+        'want_actions': {'exporter'},
+    }, {
+        'about': 'no actions',
+        'keys': ['image-retention'],
+        'want_actions': set(),
+    }, {
+        'about': 'unknown option',
+        'keys': ['no-such-option'],
+        'want_actions': {
+            'config', 'restart', 'quotas', 'image', 'pool', 'exporter'},
+    }]
+
+    def test_config_actions(self):
+        # Actions are inferred from changed config keys.
+        for test in self.tests:
+            with self.subTest(test['about']):
+                actions = jujushell.config_actions(test['keys'])
+                self.assertEqual(test['want_actions'], actions)
+
+    def test_all_options(self):
+        # Actions are defined for all config options.
+        with open(os.path.join(_root, 'config.yaml')) as stream:
+            options = yaml.safe_load(stream)['options']
+        self.assertEqual(
+            sorted(options), sorted(jujushell._CONFIG_ACTIONS))
+
+
 @patch('charmhelpers.core.hookenv.open_port')
 @patch('charmhelpers.core.hookenv.close_port')
 @patch('os.path.exists', lambda _: True)
@@ -130,18 +470,21 @@ class TestBuildConfig(unittest.TestCase):
         # Add juju addresses as an environment variable.
         os.environ['JUJU_API_ADDRESSES'] = '1.2.3.4:17070 4.3.2.1:17070'
         self.addCleanup(os.environ.pop, 'JUJU_API_ADDRESSES')
+        # Self signed certificates are stored in the unit key/value store.
+        self.kv = patch_kv(self)
+        # Metrics definitions are included in the charm.
+        shutil.copy(os.path.join(_root, 'metrics.yaml'), directory)
 
     def get_config(self):
         """Return the YAML decoded configuration file that has been created."""
         with open('files/config.yaml') as configfile:
             return yaml.safe_load(configfile)
 
-    def make_cert(self):
-        """Make a testing key pair in the current directory."""
-        with open('cert.pem', 'w') as certfile:
-            certfile.write('my cert')
-        with open('key.pem', 'w') as keyfile:
-            keyfile.write('my key')
+    def patch_create_cert(self):
+        """Patch the creation of self signed certificates."""
+        return patch(
+            'jujushell._create_self_signed_cert',
+            return_value=('my key', 'my cert'))
 
     def test_no_tls(self, mock_close_port, mock_open_port):
         # The configuration file is created correctly without TLS.
@@ -157,6 +500,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'info',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -185,6 +530,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'debug',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 80,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -216,6 +563,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'debug',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 80,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -244,6 +593,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'debug',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 8080,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -258,8 +609,7 @@ class TestBuildConfig(unittest.TestCase):
 
     def test_tls_generated(self, mock_close_port, mock_open_port):
         # TLS keys are generated if not provided.
-        self.make_cert()
-        with patch('jujushell.call') as mock_call:
+        with self.patch_create_cert() as mock_create:
             jujushell.build_config({
                 'log-level': 'trace',
                 'port': 4247,
@@ -274,6 +624,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'trace',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -285,26 +637,104 @@ class TestBuildConfig(unittest.TestCase):
             'welcome-message': '',
         }
         self.assertEqual(expected_config, self.get_config())
-        # The right command has been executed.
-        mock_call.assert_called_once_with(
-            'openssl', 'req',
-            '-x509',
-            '-newkey', 'rsa:4096',
-            '-keyout', 'key.pem',
-            '-out', 'cert.pem',
-            '-days', '365',
-            '-nodes',
-            '-subj', '/C=GB/ST=London/L=London/O=Canonical/OU=JAAS/CN=0.0.0.0')
-        # Key files has been removed.
-        self.assertEqual(['files'], os.listdir('.'))
+        # The key pair has been created in memory.
+        mock_create.assert_called_once_with('rsa')
+        self.assertEqual(['files', 'metrics.yaml'], sorted(os.listdir('.')))
         self.assertEqual(0, mock_close_port.call_count)
         mock_open_port.assert_called_once_with(4247)
 
+    def test_tls_generated_ecdsa(self, mock_close_port, mock_open_port):
+        # ECDSA keys are generated if requested.
+        with self.patch_create_cert() as mock_create:
+            jujushell.build_config({
+                'log-level': 'trace',
+                'port': 4247,
+                'tls': True,
+                'tls-cert': '',
+                'tls-key': '',
+                'tls-key-type': 'ecdsa',
+            })
+        config = self.get_config()
+        self.assertEqual('my cert', config['tls-cert'])
+        self.assertEqual('my key', config['tls-key'])
+        mock_create.assert_called_once_with('ecdsa')
+
+    def test_tls_generated_invalid_key_type(
+            self, mock_close_port, mock_open_port):
+        # A ValueError is raised if the requested key type is not supported.
+        with self.assertRaises(ValueError) as ctx:
+            jujushell.build_config({
+                'log-level': 'trace',
+                'port': 4247,
+                'tls': True,
+                'tls-cert': '',
+                'tls-key': '',
+                'tls-key-type': 'dsa',
+            })
+        self.assertEqual('invalid TLS key type: dsa', str(ctx.exception))
+        self.assertIsNone(self.kv.get('jujushell.self-signed-cert'))
+
+    def test_tls_generated_reused(self, mock_close_port, mock_open_port):
+        # Generated TLS keys are reused by subsequent calls.
+        cfg = {
+            'log-level': 'trace',
+            'port': 4247,
+            'tls': True,
+            'tls-cert': '',
+            'tls-key': '',
+        }
+        with self.patch_create_cert() as mock_create:
+            jujushell.build_config(cfg)
+            jujushell.build_config(cfg)
+        self.assertEqual(1, mock_create.call_count)
+        config = self.get_config()
+        self.assertEqual('my cert', config['tls-cert'])
+        self.assertEqual('my key', config['tls-key'])
+
+    def test_tls_generated_key_type_changed(
+            self, mock_close_port, mock_open_port):
+        # New TLS keys are generated when the requested key type changes.
+        cfg = {
+            'log-level': 'trace',
+            'port': 4247,
+            'tls': True,
+            'tls-cert': '',
+            'tls-key': '',
+        }
+        with self.patch_create_cert() as mock_create:
+            jujushell.build_config(cfg)
+            cfg['tls-key-type'] = 'ecdsa'
+            jujushell.build_config(cfg)
+        self.assertEqual(2, mock_create.call_count)
+        self.assertEqual('ecdsa', self.kv.get(
+            'jujushell.self-signed-cert')['key-type'])
+
+    def test_tls_generated_renewed(self, mock_close_port, mock_open_port):
+        # Generated TLS keys are renewed when they are about to expire.
+        cfg = {
+            'log-level': 'trace',
+            'port': 4247,
+            'tls': True,
+            'tls-cert': '',
+            'tls-key': '',
+        }
+        self.kv.set('jujushell.self-signed-cert', {
+            'cert': 'old cert',
+            'expires': time.time() + 24 * 60 * 60,
+            'key': 'old key',
+            'key-type': 'rsa',
+        })
+        with self.patch_create_cert() as mock_create:
+            jujushell.build_config(cfg)
+        self.assertEqual(1, mock_create.call_count)
+        config = self.get_config()
+        self.assertEqual('my cert', config['tls-cert'])
+        self.assertEqual('my key', config['tls-key'])
+
     def test_tls_generated_when_key_is_missing(
             self, mock_close_port, mock_open_port):
         # TLS keys are generated if only one key is provided, not both.
-        self.make_cert()
-        with patch('jujushell.call'):
+        with self.patch_create_cert():
             jujushell.build_config({
                 'log-level': 'trace',
                 'port': 4247,
@@ -319,6 +749,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'trace',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -349,6 +781,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'debug',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 443,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -380,6 +814,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'debug',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 443,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -407,6 +843,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': 'provided cert',
             'log-level': 'info',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -438,6 +876,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': 'agent cert',
             'log-level': 'info',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -450,6 +890,31 @@ class TestBuildConfig(unittest.TestCase):
         self.assertEqual(0, mock_close_port.call_count)
         mock_open_port.assert_called_once_with(4247)
 
+    def test_juju_cert_from_agent_file_cached(
+            self, mock_close_port, mock_open_port):
+        # The agent file is only parsed again when it changes.
+        agent = os.path.join(os.environ['CHARM_DIR'], '..', 'agent.conf')
+        with open(agent, 'w') as agentfile:
+            yaml.safe_dump({'cacert': 'agent cert'}, agentfile)
+        self.addCleanup(os.remove, agent)
+        cfg = {
+            'log-level': 'info',
+            'juju-cert': 'from-unit',
+            'port': 4247,
+            'tls': False,
+        }
+        jujushell.build_config(cfg)
+        with patch('builtins.open', wraps=open) as mock_open:
+            jujushell.build_config(cfg)
+        opened = [os.path.basename(c[0][0]) for c in mock_open.call_args_list]
+        self.assertNotIn('agent.conf', opened)
+        self.assertEqual('agent cert', self.get_config()['juju-cert'])
+        # Update the agent file.
+        with open(agent, 'w') as agentfile:
+            yaml.safe_dump({'cacert': 'new agent cert'}, agentfile)
+        jujushell.build_config(cfg)
+        self.assertEqual('new agent cert', self.get_config()['juju-cert'])
+
     def test_provided_juju_addresses(self, mock_close_port, mock_open_port):
         # Juju addresses can be provided via the configuration.
         jujushell.build_config({
@@ -465,6 +930,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'info',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -508,6 +975,186 @@ class TestBuildConfig(unittest.TestCase):
         self.assertEqual(0, mock_close_port.call_count)
         self.assertEqual(0, mock_open_port.call_count)
 
+    def test_changed(self, mock_close_port, mock_open_port):
+        # True is returned when the config file is created or changed.
+        cfg = {
+            'log-level': 'info',
+            'port': 4247,
+            'tls': False,
+        }
+        self.assertTrue(jujushell.build_config(cfg))
+        cfg['log-level'] = 'debug'
+        self.assertTrue(jujushell.build_config(cfg))
+        self.assertEqual('debug', self.get_config()['log-level'])
+        # No temporary files are left behind.
+        self.assertEqual(
+            ['config.yaml', 'metrics.json'], sorted(os.listdir('files')))
+
+    def test_unchanged(self, mock_close_port, mock_open_port):
+        # The config file is not written again if its content is unchanged.
+        cfg = {
+            'log-level': 'info',
+            'port': 4247,
+            'tls': False,
+        }
+        jujushell.build_config(cfg)
+        with patch('os.fsync') as mock_fsync:
+            with patch('charmhelpers.core.hookenv.log') as mock_log:
+                changed = jujushell.build_config(cfg)
+        self.assertFalse(changed)
+        self.assertEqual(0, mock_fsync.call_count)
+        files = os.path.join(os.getcwd(), 'files')
+        self.assertEqual([
+            call('{}/metrics.json is already up to date'.format(files)),
+            call('{}/config.yaml is already up to date'.format(files)),
+        ], mock_log.call_args_list)
+
+    def test_flushed(self, mock_close_port, mock_open_port):
+        # The config file and its directory are flushed to disk.
+        with patch('os.fsync') as mock_fsync:
+            jujushell.build_config({
+                'log-level': 'info',
+                'port': 4247,
+                'tls': False,
+            })
+        # Both the config and the metrics files are flushed.
+        self.assertEqual(4, mock_fsync.call_count)
+
+    def test_write_error(self, mock_close_port, mock_open_port):
+        # The temporary file is removed if the config file cannot be written.
+        with patch('os.rename', side_effect=OSError('bad wolf')):
+            with self.assertRaises(OSError) as ctx:
+                jujushell.build_config({
+                    'log-level': 'info',
+                    'port': 4247,
+                    'tls': False,
+                })
+        self.assertEqual('bad wolf', str(ctx.exception))
+        self.assertEqual([], os.listdir('files'))
+
+    def test_metrics(self, mock_close_port, mock_open_port):
+        # The file used by the collect-metrics hook is created.
+        jujushell.build_config({
+            'log-level': 'info',
+            'port': 4247,
+            'tls': False,
+        })
+        with open('files/metrics.json') as stream:
+            info = json.load(stream)
+        self.assertEqual({
+            'metrics': [
+                'containers_duration_p50',
+                'containers_duration_p95',
+                'containers_duration_p99',
+                'containers_in_flight',
+                'errors_count',
+                'metrics_staleness',
+                'requests_count',
+                'requests_duration_p50',
+                'requests_duration_p95',
+                'requests_duration_p99',
+                'requests_duration_sum',
+                'requests_in_flight',
+            ],
+            'urls': ['http://localhost:4247/metrics'],
+        }, info)
+
+    def test_metrics_tls(self, mock_close_port, mock_open_port):
+        # The metrics URL reflects the TLS configuration.
+        jujushell.build_config({
+            'dns-name': 'shell.example.com',
+            'log-level': 'info',
+            'port': 443,
+            'tls': True,
+        })
+        with open('files/metrics.json') as stream:
+            info = json.load(stream)
+        self.assertEqual(
+            ['https://shell.example.com:443/metrics'], info['urls'])
+
+    def test_metrics_listener(self, mock_close_port, mock_open_port):
+        # A plaintext metrics listener is configured on the loopback interface
+        # and used for retrieving metrics.
+        jujushell.build_config({
+            'dns-name': 'shell.example.com',
+            'log-level': 'info',
+            'metrics-port': 8048,
+            'port': 443,
+            'tls': True,
+        })
+        self.assertEqual('127.0.0.1:8048', self.get_config()['metrics-addr'])
+        with open('files/metrics.json') as stream:
+            info = json.load(stream)
+        self.assertEqual([
+            'http://127.0.0.1:8048/metrics',
+            'https://shell.example.com:443/metrics',
+        ], info['urls'])
+        # The metrics port is not opened.
+        mock_open_port.assert_called_once_with(443)
+
+    def test_metrics_port_conflict(self, mock_close_port, mock_open_port):
+        # The metrics port cannot be the same as the service port.
+        with self.assertRaises(ValueError) as ctx:
+            jujushell.build_config({
+                'log-level': 'info',
+                'metrics-port': 8048,
+                'port': 8048,
+                'tls': False,
+            })
+        self.assertEqual(
+            'metrics port 8048 is already used by the service',
+            str(ctx.exception))
+        self.assertFalse(mock_open_port.called)
+
+    def test_quota_tiers(self, mock_close_port, mock_open_port):
+        # Users assigned to quota tiers get the corresponding profiles.
+        jujushell.build_config({
+            'allowed-users': 'who dalek rose@external',
+            'log-level': 'info',
+            'lxc-quota-tiers': 'heavy: {cpu-cores: 4}\ncasual: {ram: 128MB}',
+            'lxc-quota-tier-users': 'who=heavy rose@external=casual',
+            'port': 4247,
+            'tls': False,
+        })
+        config = self.get_config()
+        self.assertEqual(['who', 'dalek', 'rose@external'],
+                         config['allowed-users'])
+        self.assertEqual({
+            'rose@external': [
+                jujushell.PROFILE_TERMSERVER,
+                jujushell.PROFILE_TERMSERVER_LIMITED,
+                'termserver-tier-casual',
+            ],
+            'who': [
+                jujushell.PROFILE_TERMSERVER,
+                jujushell.PROFILE_TERMSERVER_LIMITED,
+                'termserver-tier-heavy',
+            ],
+        }, config['user-profiles'])
+
+    def test_quota_tiers_errors(self, mock_close_port, mock_open_port):
+        # A ValueError is raised if users are not properly assigned to tiers.
+        tests = [
+            ('who', "invalid LXC quota tier assignment 'who'"),
+            ('who=', "invalid LXC quota tier assignment 'who='"),
+            ('=heavy', "invalid LXC quota tier assignment '=heavy'"),
+            ('who=light', "unknown LXC quota tier 'light' for user who"),
+        ]
+        for users, want_error in tests:
+            with self.subTest(users):
+                with self.assertRaises(ValueError) as ctx:
+                    jujushell.build_config({
+                        'log-level': 'info',
+                        'lxc-quota-tiers': 'heavy: {cpu-cores: 4}',
+                        'lxc-quota-tier-users': users,
+                        'port': 4247,
+                        'tls': False,
+                    })
+                self.assertEqual(want_error, str(ctx.exception))
+        # Ports are not changed and the config file is not written.
+        self.assertEqual(0, mock_open_port.call_count)
+        self.assertEqual([], os.listdir('files'))
+
     def test_allowed_users(self, mock_close_port, mock_open_port):
         # The list of allowed users is properly generated.
         jujushell.build_config({
@@ -523,6 +1170,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'info',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -550,6 +1199,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'info',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -562,6 +1213,35 @@ class TestBuildConfig(unittest.TestCase):
         self.assertEqual(0, mock_close_port.call_count)
         mock_open_port.assert_called_once_with(4247)
 
+    def test_config_replaced(self, mock_close_port, mock_open_port):
+        # An existing configuration file is replaced.
+        with open('files/config.yaml', 'w') as configfile:
+            configfile.write('exterminate: true')
+        jujushell.build_config({
+            'log-level': 'info',
+            'port': 4247,
+            'tls': False,
+        })
+        config = self.get_config()
+        self.assertNotIn('exterminate', config)
+        self.assertEqual('info', config['log-level'])
+        # No temporary files are left behind.
+        self.assertEqual(
+            ['config.yaml', 'metrics.json'], sorted(os.listdir('files')))
+        self.assertEqual(0o644, os.stat('files/config.yaml').st_mode & 0o777)
+
+    def test_warm_pool_size(self, mock_close_port, mock_open_port):
+        # The warm pool size is properly generated.
+        jujushell.build_config({
+            'log-level': 'info',
+            'port': 4247,
+            'tls': False,
+            'warm-pool-size': 5,
+        })
+        config = self.get_config()
+        self.assertEqual('termserver-pool-', config['pool-prefix'])
+        self.assertEqual(5, config['pool-size'])
+
     def test_welcome_message(self, mock_close_port, mock_open_port):
         # The welcome message is properly handled.
         jujushell.build_config({
@@ -577,6 +1257,8 @@ class TestBuildConfig(unittest.TestCase):
             'juju-cert': '',
             'log-level': 'info',
             'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'pool-prefix': 'termserver-pool-',
+            'pool-size': 0,
             'port': 4247,
             'profiles': [
                 jujushell.PROFILE_TERMSERVER,
@@ -590,6 +1272,36 @@ class TestBuildConfig(unittest.TestCase):
         mock_open_port.assert_called_once_with(4247)
 
 
+class TestYAML(unittest.TestCase):
+
+    def test_load(self):
+        # YAML documents are loaded from strings and streams.
+        self.assertEqual({'a': [1, 2]}, jujushell.load_yaml('a: [1, 2]'))
+        with tempfile.TemporaryFile('w+') as stream:
+            stream.write('b: c\n')
+            stream.seek(0)
+            self.assertEqual({'b': 'c'}, jujushell.load_yaml(stream))
+
+    def test_load_safe(self):
+        # Arbitrary Python objects cannot be loaded.
+        with self.assertRaises(yaml.YAMLError):
+            jujushell.load_yaml('!!python/object/apply:os.getcwd []')
+
+    def test_dump(self):
+        # Data is dumped in block style and can be loaded back.
+        data = {'key': 'value', 'list': ['a', 'b'], 'number': 42}
+        dumped = jujushell.dump_yaml(data)
+        self.assertEqual(yaml.safe_dump(data), dumped)
+        self.assertEqual(data, jujushell.load_yaml(dumped))
+
+    def test_libyaml(self):
+        # The libyaml based loader and dumper are used when available.
+        if not hasattr(yaml, 'CSafeLoader'):
+            self.skipTest('libyaml is not available')
+        self.assertIs(yaml.CSafeLoader, jujushell._YAML_LOADER)
+        self.assertIs(yaml.CSafeDumper, jujushell._YAML_DUMPER)
+
+
 class TestGetPorts(unittest.TestCase):
 
     def test_with_dns_name(self):
@@ -621,9 +1333,87 @@ class TestGetPorts(unittest.TestCase):
         self.assertEqual((4247,), ports)
 
 
+class TestPrometheusPort(unittest.TestCase):
+
+    def test_exporter(self):
+        # The exporter port is used when the exporter is enabled.
+        port = jujushell.prometheus_port({
+            'exporter-port': 9117, 'port': 4247, 'tls': True})
+        self.assertEqual(9117, port)
+
+    def test_no_exporter(self):
+        # The jujushell port is used when the exporter is disabled.
+        port = jujushell.prometheus_port({
+            'exporter-port': 0, 'port': 4247, 'tls': True})
+        self.assertEqual(4247, port)
+
+
+class TestCreateSelfSignedCert(unittest.TestCase):
+
+    def load(self, key_pem, cert_pem):
+        """Load and return the given PEM encoded key and certificate."""
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        backend = default_backend()
+        key = serialization.load_pem_private_key(
+            key_pem.encode('ascii'), None, backend)
+        cert = x509.load_pem_x509_certificate(
+            cert_pem.encode('ascii'), backend)
+        return key, cert
+
+    def check_cert(self, key, cert):
+        """Check that the given certificate is self signed with the key."""
+        from cryptography.x509.oid import NameOID
+        self.assertEqual(cert.subject, cert.issuer)
+        self.assertEqual(
+            '0.0.0.0',
+            cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value)
+        self.assertEqual(
+            key.public_key().public_numbers(),
+            cert.public_key().public_numbers())
+        validity = cert.not_valid_after - cert.not_valid_before
+        self.assertEqual(365, validity.days)
+
+    def test_ecdsa(self):
+        # ECDSA keys are created on the P-256 curve.
+        from cryptography.hazmat.primitives.asymmetric import ec
+        key, cert = self.load(*jujushell._create_self_signed_cert('ecdsa'))
+        self.assertIsInstance(key, ec.EllipticCurvePrivateKey)
+        self.assertEqual('secp256r1', key.curve.name)
+        self.check_cert(key, cert)
+
+    def test_rsa(self):
+        # RSA keys are 4096 bits long.
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key, cert = self.load(*jujushell._create_self_signed_cert('rsa'))
+        self.assertIsInstance(key, rsa.RSAPrivateKey)
+        self.assertEqual(4096, key.key_size)
+        self.check_cert(key, cert)
+
+    def test_no_files(self):
+        # No files are written when creating the key pair.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        self.addCleanup(os.chdir, cwd)
+        jujushell._create_self_signed_cert('ecdsa')
+        self.assertEqual([], os.listdir('.'))
+
+    def test_invalid_key_type(self):
+        # A ValueError is raised for unsupported key types.
+        with self.assertRaises(ValueError) as ctx:
+            jujushell._create_self_signed_cert('dsa')
+        self.assertEqual('invalid TLS key type: dsa', str(ctx.exception))
+
+
 @patch('charmhelpers.core.hookenv.log')
 class TestSaveResource(unittest.TestCase):
 
+    def setUp(self):
+        self.kv = patch_kv(self)
+
     def test_resource_retrieved(self, mock_log):
         # A resource can be successfully retrieved and stored.
         with patch('charmhelpers.core.hookenv.resource_get') as mock_get:
@@ -655,65 +1445,512 @@ class TestSaveResource(unittest.TestCase):
         self.assertFalse(os.path.isfile(resource))
         mock_get.assert_called_once_with('myresource')
 
+    def test_fingerprint_forgotten(self, mock_log):
+        # The cached fingerprint of a replaced resource is removed.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        resource = os.path.join(directory, 'resource')
+        with open(resource, 'w') as resource_file:
+            resource_file.write('resource content')
+        path = os.path.join(directory, 'target')
+        self.kv.set(jujushell._FINGERPRINTS_KEY, {
+            path: {'signature': [1, 2, 3], 'fingerprint': 'old'},
+            'other': {'signature': [4, 5, 6], 'fingerprint': 'other'},
+        })
+        with patch('charmhelpers.core.hookenv.resource_get') as mock_get:
+            mock_get.return_value = resource
+            jujushell.save_resource('myresource', path)
+        self.assertEqual(
+            {'other': {'signature': [4, 5, 6], 'fingerprint': 'other'}},
+            self.kv.get(jujushell._FINGERPRINTS_KEY))
+
+    def test_concurrent(self, mock_log):
+        # Resources are retrieved concurrently.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        barrier = threading.Barrier(2, timeout=5)
+
+        def resource_get(name):
+            # Both resources must be retrieved at the same time.
+            barrier.wait()
+            resource = os.path.join(directory, name)
+            with open(resource, 'w') as resource_file:
+                resource_file.write(name + ' content')
+            return resource
+
+        paths = [os.path.join(directory, 'target' + i) for i in '12']
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            jujushell.fetch_resource('r1', paths[0])
+            jujushell.save_resource('r2', paths[1])
+            jujushell.save_resource('r1', paths[0])
+        for name, path in zip(('r1', 'r2'), paths):
+            with open(path) as target_file:
+                self.assertEqual(name + ' content', target_file.read())
+        self.assertEqual({}, jujushell._resource_futures)
+
+    def test_remove(self, mock_log):
+        # Resources can be removed.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'target')
+        with open(path, 'w') as target_file:
+            target_file.write('resource content')
+        self.kv.set(jujushell._FINGERPRINTS_KEY, {
+            path: {'signature': [1, 2, 3], 'fingerprint': 'target'},
+        })
+        with patch('jujushell.clear_flag') as mock_clear_flag:
+            jujushell.remove_resource('myresource', path)
+            # Removing a resource again is not an error.
+            jujushell.remove_resource('myresource', path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual({}, self.kv.get(jujushell._FINGERPRINTS_KEY))
+        mock_clear_flag.assert_called_with(
+            'jujushell.resource.available.myresource')
+
+    def test_background(self, mock_log):
+        # Resources can be saved when the hook exits.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        resource = os.path.join(directory, 'resource')
+        with open(resource, 'w') as resource_file:
+            resource_file.write('resource content')
+        path = os.path.join(directory, 'target')
+        with patch('charmhelpers.core.hookenv.resource_get') as mock_get:
+            mock_get.return_value = resource
+            with patch('charmhelpers.core.hookenv.atexit') as mock_atexit:
+                jujushell.save_resource_in_background('myresource', path)
+            # The resource is saved when the hook exits.
+            with patch('jujushell.set_flag') as mock_set_flag:
+                mock_atexit.call_args[0][0]()
+        # The retrieval may only complete when waited for.
+        mock_get.assert_called_once_with('myresource')
+        mock_set_flag.assert_called_once_with(
+            'jujushell.resource.available.myresource')
+        with open(path) as target_file:
+            self.assertEqual('resource content', target_file.read())
+
+    def test_background_error(self, mock_log):
+        # Errors retrieving resources in the background are logged.
+        with patch('charmhelpers.core.hookenv.resource_get') as mock_get:
+            mock_get.return_value = ''
+            with patch('charmhelpers.core.hookenv.atexit') as mock_atexit:
+                jujushell.save_resource_in_background('bad-resource', 'path')
+            with patch('jujushell.set_flag') as mock_set_flag:
+                mock_atexit.call_args[0][0]()
+        self.assertFalse(mock_set_flag.called)
+        mock_log.assert_called_with(
+            "cannot save resource 'bad-resource': "
+            "cannot retrieve resource 'bad-resource'")
+
 
 @patch('charmhelpers.core.hookenv.log')
 class TestImportLXDImage(unittest.TestCase):
 
     def setUp(self):
+        self.kv = patch_kv(self)
         directory = tempfile.mkdtemp()
         self.addCleanup(shutil.rmtree, directory)
+        # Image import stats are stored in the charm files.
+        os.mkdir(os.path.join(directory, 'files'))
+        os.environ['CHARM_DIR'] = directory
+        self.addCleanup(os.environ.pop, 'CHARM_DIR')
         self.path = os.path.join(directory, 'image')
         with open(self.path, 'wb') as f:
             f.write(b'AAAAAAAAAA')
+        self.fingerprint = \
+            '1d65bf29403e4fb1767522a107c827b8884d16640cf0e3b18c4c1dd107e0d49d'
+        self.uploaded_size = 0
+        self.uploaded_fingerprint = ''
 
     def test_no_images(self, mock_log):
-        with patch('jujushell._lxd_client') as mock_client:
-            mock_client().images.all.return_value = ()
+        with self.patch_lxd_client([]) as client:
+            changed = jujushell.import_lxd_image('test', self.path)
+        self.assertTrue(changed)
+        self.assertEqual(10, self.uploaded_size)
+        self.assertEqual(self.fingerprint, self.uploaded_fingerprint)
+        client.operations.wait_for_operation.assert_called_once_with(
+            '/1.0/operations/42')
+        [image] = client.images.all()
+        self.assertEqual(self.fingerprint, image.fingerprint)
+        image.add_alias.assert_called_once_with('test', '')
+
+    def test_import_stats(self, mock_log):
+        # The time spent importing images is recorded.
+        with self.patch_lxd_client([]):
             jujushell.import_lxd_image('test', self.path)
-        mock_client().images.create.assert_called_once_with(
-            b'AAAAAAAAAA',
-            wait=True)
-        mock_client().images.create().add_alias.assert_called_once_with(
-            'test',
-            '')
+        with self.patch_lxd_client([]):
+            jujushell.import_lxd_image('another', self.path)
+        with open(jujushell.stats_path()) as stream:
+            stats = json.load(stream)
+        imports = stats['image-imports']
+        self.assertEqual(['another', 'test'], sorted(imports))
+        for info in imports.values():
+            self.assertGreaterEqual(info['seconds'], 0)
+            self.assertAlmostEqual(time.time(), info['time'], delta=60)
 
     def test_image_exists(self, mock_log):
-        image = Mock()
-        image.fingerprint = \
-            '1d65bf29403e4fb1767522a107c827b8884d16640cf0e3b18c4c1dd107e0d49d'
-        image.aliases = [{'name': 'test', 'description': ''}]
-        with patch('jujushell._lxd_client') as mock_client:
-            mock_client().images.all.return_value = [image]
-            jujushell.import_lxd_image('test', self.path)
-        mock_client().images.create.assert_not_called()
+        image = self.make_image(self.fingerprint, 'test')
+        with self.patch_lxd_client([image]) as client:
+            changed = jujushell.import_lxd_image('test', self.path)
+        self.assertFalse(changed)
+        self.assertFalse(client.api.images.post.called)
+        self.assertFalse(image.add_alias.called)
+        self.assertFalse(image.delete_alias.called)
+        self.assertFalse(client.images.all.called)
 
     def test_image_exists_no_alias(self, mock_log):
-        image = Mock()
-        image.fingerprint = \
-            '1d65bf29403e4fb1767522a107c827b8884d16640cf0e3b18c4c1dd107e0d49d'
-        image.aliases = []
-        with patch('jujushell._lxd_client') as mock_client:
-            mock_client().images.all.return_value = [image]
+        image = self.make_image(self.fingerprint)
+        with self.patch_lxd_client([image]) as client:
             jujushell.import_lxd_image('test', self.path)
-        mock_client().images.create.assert_not_called()
+        self.assertFalse(client.api.images.post.called)
         image.add_alias.assert_called_once_with('test', '')
 
     def test_image_with_alias_exists(self, mock_log):
-        image = Mock()
-        image.fingerprint = \
-            '2d65bf29403e4fb1767522a107c827b8884d16640cf0e3b18c4c1dd107e0d49d'
-        image.aliases = [{'name': 'test', 'description': ''}]
-        with patch('jujushell._lxd_client') as mock_client:
-            mock_client().images.all.return_value = [image]
-            jujushell.import_lxd_image('test', self.path)
-        mock_client().images.create.assert_called_once_with(
-            b'AAAAAAAAAA',
-            wait=True)
-        mock_client().images.create().add_alias.assert_called_once_with(
-            'test',
-            '')
+        image = self.make_image(
+            '2d65bf29403e4fb1767522a107c827b8884d16640cf0e3b18c4c1dd107e0d49d',
+            'test')
+        with self.patch_lxd_client([image]) as client:
+            changed = jujushell.import_lxd_image('test', self.path)
+        self.assertTrue(changed)
+        self.assertEqual(10, self.uploaded_size)
+        self.assertEqual(self.fingerprint, self.uploaded_fingerprint)
+        _, new_image = client.images.all()
+        new_image.add_alias.assert_called_once_with('test', '')
         image.delete_alias.assert_called_once_with('test')
 
+    def test_many_images(self, mock_log):
+        # Images are looked up directly, regardless of how many are stored.
+        images = [
+            self.make_image('{:064x}'.format(i), 'alias-{}'.format(i))
+            for i in range(100)
+        ]
+        images.append(self.make_image(self.fingerprint, 'test'))
+        with self.patch_lxd_client(images) as client:
+            jujushell.import_lxd_image('test', self.path)
+        self.assertFalse(client.api.images.post.called)
+        self.assertFalse(client.images.all.called)
+        client.images.get.assert_called_once_with(self.fingerprint)
+        client.images.get_by_alias.assert_called_once_with('test')
+
+    def test_lookup_error_scan(self, mock_log):
+        # All images are scanned if they cannot be looked up directly.
+        old_image = self.make_image(
+            '2d65bf29403e4fb1767522a107c827b8884d16640cf0e3b18c4c1dd107e0d49d',
+            'test')
+        image = self.make_image(self.fingerprint)
+        with self.patch_lxd_client([old_image, image]) as client:
+            response = Mock(status_code=500)
+            response.json.return_value = {'error': 'bad wolf'}
+            error = exceptions.LXDAPIException(response)
+            client.images.get_by_alias.side_effect = error
+            jujushell.import_lxd_image('test', self.path)
+        self.assertFalse(client.api.images.post.called)
+        self.assertTrue(client.images.all.called)
+        mock_log.assert_any_call(
+            'cannot look up images, scanning all: bad wolf')
+        old_image.delete_alias.assert_called_once_with('test')
+        image.add_alias.assert_called_once_with('test', '')
+
+    def test_large_image_bounded_memory(self, mock_log):
+        # Large images are hashed and uploaded without loading them in memory.
+        size = 64 * 1024 * 1024
+        with open(self.path, 'wb') as f:
+            f.truncate(size)
+        with self.patch_lxd_client([]):
+            tracemalloc.start()
+            self.addCleanup(tracemalloc.stop)
+            jujushell.import_lxd_image('test', self.path)
+            _, peak = tracemalloc.get_traced_memory()
+        self.assertEqual(size, self.uploaded_size)
+        self.assertLess(peak, 4 * jujushell._CHUNK_SIZE)
+
+    def test_fingerprint_cached(self, mock_log):
+        # Image fingerprints are cached while the image file is unchanged.
+        with self.patch_lxd_client([]):
+            jujushell.import_lxd_image('test', self.path)
+            with patch('jujushell._sha256') as mock_sha256:
+                jujushell.import_lxd_image('test', self.path)
+        self.assertFalse(mock_sha256.called)
+        self.assertEqual(
+            self.fingerprint,
+            self.kv.get(jujushell._FINGERPRINTS_KEY)[self.path]['fingerprint'])
+
+    def test_fingerprint_cache_invalidated(self, mock_log):
+        # Image fingerprints are computed again when the image file changes.
+        with self.patch_lxd_client([]):
+            jujushell.import_lxd_image('test', self.path)
+            with open(self.path, 'ab') as f:
+                f.write(b'B')
+            jujushell.import_lxd_image('test', self.path)
+        want_fingerprint = hashlib.sha256(b'AAAAAAAAAAB').hexdigest()
+        self.assertEqual(want_fingerprint, self.uploaded_fingerprint)
+        self.assertEqual(
+            want_fingerprint,
+            self.kv.get(jujushell._FINGERPRINTS_KEY)[self.path]['fingerprint'])
+
+    def import_in_background(self, images, running=False, failed=False):
+        """Import the test image in the background.
+
+        Use the given LXD images, and simulate the import unit being running
+        or failed. Return the result, the mock call function and the mock
+        set_flag function.
+        """
+        def service(action, unit):
+            self.assertEqual('is-failed', action)
+            self.assertEqual('jujushell-import-test', unit)
+            return failed
+
+        with self.patch_lxd_client(images):
+            with patch('charmhelpers.core.host.service_running',
+                       return_value=running) as mock_running, \
+                    patch('charmhelpers.core.host.service',
+                          side_effect=service), \
+                    patch('jujushell.call') as mock_call, \
+                    patch('jujushell.set_flag') as mock_set_flag:
+                done = jujushell.import_lxd_image_in_background(
+                    'test', self.path)
+        mock_running.assert_called_once_with('jujushell-import-test')
+        return done, mock_call, mock_set_flag
+
+    def test_background_start(self, mock_log):
+        # The image import is started in a transient systemd unit.
+        done, mock_call, mock_set_flag = self.import_in_background([])
+        self.assertFalse(done)
+        mock_call.assert_called_once_with(
+            'systemd-run', '--unit', 'jujushell-import-test', jujushell.LXC,
+            'image', 'import', self.path, timeout=60)
+        self.assertFalse(mock_set_flag.called)
+
+    def test_background_running(self, mock_log):
+        # Nothing is done while the import is in progress.
+        done, mock_call, mock_set_flag = self.import_in_background(
+            [], running=True)
+        self.assertFalse(done)
+        self.assertFalse(mock_call.called)
+        self.assertFalse(mock_set_flag.called)
+
+    def test_background_failed(self, mock_log):
+        # Failed imports are started again.
+        done, mock_call, _ = self.import_in_background([], failed=True)
+        self.assertFalse(done)
+        mock_call.assert_has_calls([
+            call('systemctl', 'reset-failed', 'jujushell-import-test',
+                 timeout=60),
+            call('systemd-run', '--unit', 'jujushell-import-test',
+                 jujushell.LXC, 'image', 'import', self.path, timeout=60),
+        ])
+        mock_log.assert_any_call('previous import of image test failed')
+
+    def test_background_done(self, mock_log):
+        # The imported image is aliased.
+        image = self.make_image(self.fingerprint)
+        done, mock_call, mock_set_flag = self.import_in_background([image])
+        self.assertTrue(done)
+        self.assertFalse(mock_call.called)
+        image.add_alias.assert_called_once_with('test', '')
+        mock_set_flag.assert_called_once_with(
+            'jujushell.lxd.image.imported.test')
+
+    def test_switch(self, mock_log):
+        # The alias is changed to refer to another image.
+        old_image = self.make_image('old', 'test')
+        image = self.make_image(self.fingerprint, 'test-full')
+        with self.patch_lxd_client([old_image, image]) as client:
+            with patch('jujushell.set_flag') as mock_set_flag:
+                changed = jujushell.switch_lxd_image('test', 'test-full')
+        self.assertTrue(changed)
+        old_image.delete_alias.assert_called_once_with('test')
+        image.add_alias.assert_called_once_with('test', '')
+        self.assertFalse(client.api.images.post.called)
+        mock_set_flag.assert_called_once_with(
+            'jujushell.lxd.image.imported.test')
+
+    def test_switch_no_alias(self, mock_log):
+        # The alias is created if it does not exist.
+        image = self.make_image(self.fingerprint, 'test-full')
+        with self.patch_lxd_client([image]):
+            changed = jujushell.switch_lxd_image('test', 'test-full')
+        self.assertTrue(changed)
+        image.add_alias.assert_called_once_with('test', '')
+
+    def test_switch_unchanged(self, mock_log):
+        # Nothing changes if the alias already refers to the image.
+        image = self.make_image(self.fingerprint, 'test', 'test-full')
+        with self.patch_lxd_client([image]):
+            changed = jujushell.switch_lxd_image('test', 'test-full')
+        self.assertFalse(changed)
+        self.assertFalse(image.add_alias.called)
+        self.assertFalse(image.delete_alias.called)
+
+    def test_switch_not_found(self, mock_log):
+        # A ValueError is raised if the source image does not exist.
+        image = self.make_image(self.fingerprint, 'test')
+        with self.patch_lxd_client([image]):
+            with self.assertRaises(ValueError) as ctx:
+                jujushell.switch_lxd_image('test', 'test-full')
+        self.assertEqual('cannot find image test-full', str(ctx.exception))
+        self.assertFalse(image.delete_alias.called)
+
+    def test_image_variant(self, mock_log):
+        self.assertEqual('termserver-full', jujushell.image_variant())
+        self.assertEqual(
+            'termserver-limited', jujushell.image_variant(limited=True))
+
+    def make_image(self, fingerprint, *aliases):
+        """Create and return a mock image with the given aliases."""
+        image = Mock()
+        image.fingerprint = fingerprint
+        image.aliases = [
+            {'name': alias, 'description': ''} for alias in aliases]
+        return image
+
+    def patch_lxd_client(self, images):
+        """Patch the LXD client so that it includes the given images.
+
+        Uploading an image adds a new image to the client.
+        """
+        def get(fingerprint):
+            for image in images:
+                if image.fingerprint == fingerprint:
+                    return image
+            raise exceptions.NotFound(Mock())
+
+        def get_by_alias(name):
+            for image in images:
+                if name in [alias['name'] for alias in image.aliases]:
+                    return image
+            raise exceptions.NotFound(Mock())
+
+        def post(data=None):
+            response = self.post(data=data)
+            images.append(self.make_image(self.uploaded_fingerprint))
+            return response
+
+        client = Mock()
+        client.images.all.side_effect = lambda: images
+        client.images.get.side_effect = get
+        client.images.get_by_alias.side_effect = get_by_alias
+        client.api.images.post.side_effect = post
+        return patch_lxd_client(client)
+
+    def post(self, data=None):
+        """Simulate an image upload by reading the given file in chunks.
+
+        Store the size and the hash of the uploaded content.
+        """
+        h = hashlib.sha256()
+        for chunk in iter(lambda: data.read(jujushell._CHUNK_SIZE), b''):
+            self.uploaded_size += len(chunk)
+            h.update(chunk)
+        self.uploaded_fingerprint = h.hexdigest()
+        response = Mock()
+        response.json.return_value = {'operation': '/1.0/operations/42'}
+        return response
+
+
+@patch('jujushell._list_containers', list_containers)
+@patch('charmhelpers.core.hookenv.log')
+class TestCollectLXDImages(unittest.TestCase):
+
+    def test_collect(self, mock_log):
+        # Old images are removed.
+        images = [
+            ('i4', '2018-04-01', 4, ['termserver']),
+            ('i1', '2018-01-01', 1, []),
+            ('i3', '2018-03-01', 3, []),
+            ('i2', '2018-02-01', 2, []),
+        ]
+        with self.patch_lxd_client(images, []) as client:
+            removed, reclaimed = jujushell.collect_lxd_images(2)
+        self.assertEqual(('i2', 'i1'), removed)
+        self.assertEqual(3, reclaimed)
+        i4, i1, i3, i2 = client.images.all()
+        i1.delete.assert_called_once_with(wait=True)
+        i2.delete.assert_called_once_with(wait=True)
+        self.assertFalse(i3.delete.called)
+        self.assertFalse(i4.delete.called)
+        mock_log.assert_called_with('3 bytes reclaimed by removing 2 images')
+
+    def test_collect_dry(self, mock_log):
+        # Old images are not removed in dry mode.
+        images = [
+            ('i2', '2018-02-01', 2, ['termserver']),
+            ('i1', '2018-01-01', 1, []),
+        ]
+        with self.patch_lxd_client(images, []) as client:
+            removed, reclaimed = jujushell.collect_lxd_images(1, dry=True)
+        self.assertEqual(('i1',), removed)
+        self.assertEqual(1, reclaimed)
+        for image in client.images.all():
+            self.assertFalse(image.delete.called)
+
+    def test_collect_in_use(self, mock_log):
+        # Images used by containers or with aliases are not removed.
+        images = [
+            ('i3', '2018-03-01', 3, ['termserver']),
+            ('i2', '2018-02-01', 2, ['other']),
+            ('i1', '2018-01-01', 1, []),
+        ]
+        with self.patch_lxd_client(images, ['i1', 'i1']) as client:
+            removed, reclaimed = jujushell.collect_lxd_images(1)
+        self.assertEqual((), removed)
+        self.assertEqual(0, reclaimed)
+        for image in client.images.all():
+            self.assertFalse(image.delete.called)
+
+    def test_collect_negative(self, mock_log):
+        # A ValueError is raised if the number of images to keep is negative.
+        images = [
+            ('i1', '2018-01-01', 1, []),
+        ]
+        with self.patch_lxd_client(images, []) as client:
+            with self.assertRaises(ValueError) as ctx:
+                jujushell.collect_lxd_images(-1)
+        self.assertEqual(
+            'invalid number of images to keep: -1', str(ctx.exception))
+        for image in client.images.all():
+            self.assertFalse(image.delete.called)
+
+    def test_collect_nothing(self, mock_log):
+        # Nothing is removed if there are less images than the ones to keep.
+        images = [
+            ('i1', '2018-01-01', 1, []),
+        ]
+        with self.patch_lxd_client(images, []):
+            removed, reclaimed = jujushell.collect_lxd_images(3)
+        self.assertEqual((), removed)
+        self.assertEqual(0, reclaimed)
+
+    def patch_lxd_client(self, images, base_images):
+        """Patch the LXD client and make it return the given images.
+
+        Images are expressed as tuples (fingerprint: str, uploaded_at: str,
+        size: int, aliases: list). Containers are created for each of the
+        given base image fingerprints.
+        """
+        image_results = [
+            type('Image', (object,), {
+                'fingerprint': fingerprint,
+                'uploaded_at': uploaded_at,
+                'size': size,
+                'aliases': [{'name': name} for name in aliases],
+                'delete': Mock(),
+            }) for fingerprint, uploaded_at, size, aliases in images
+        ]
+        container_results = [
+            type('Container', (object,), {
+                'config': {'volatile.base_image': fingerprint},
+            }) for fingerprint in base_images
+        ]
+        return patch('jujushell._lxd_client', type('Client', (object, ), {
+            'containers': type('Containers', (object,), {
+                'all': lambda: container_results,
+            }),
+            'images': type('Images', (object,), {
+                'all': lambda: image_results,
+            }),
+        }))
+
 
 @patch('charmhelpers.core.hookenv.log')
 class TestSetupLXD(unittest.TestCase):
@@ -725,8 +1962,10 @@ class TestSetupLXD(unittest.TestCase):
                 jujushell.setup_lxd()
         self.assertEqual(2, mock_call.call_count)
         mock_call.assert_has_calls([
-            call(jujushell._LXD_INIT_COMMAND, shell=True, cwd='/'),
-            call(jujushell._LXD_WAIT_COMMAND, shell=True, cwd='/'),
+            call(
+                jujushell._LXD_INIT_COMMAND, shell=True, cwd='/', timeout=600),
+            call(
+                jujushell._LXD_WAIT_COMMAND, shell=True, cwd='/', timeout=60),
         ])
 
     def test_initialized(self, mock_log):
@@ -737,9 +1976,66 @@ class TestSetupLXD(unittest.TestCase):
             with patch('jujushell.call') as mock_call:
                 jujushell.setup_lxd()
         mock_call.assert_called_once_with(
-            jujushell._LXD_WAIT_COMMAND, shell=True, cwd='/')
+            jujushell._LXD_WAIT_COMMAND, shell=True, cwd='/', timeout=60)
 
 
+@patch('charmhelpers.core.hookenv.status_set')
+@patch('jujushell.set_flag')
+class TestInstallExporter(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['CHARM_DIR'] = '/charm'
+        self.addCleanup(os.environ.pop, 'CHARM_DIR')
+
+    @patch('os.path.exists', lambda _: True)
+    def test_install(self, mock_set_flag, mock_status_set):
+        # The exporter service is rendered, enabled and restarted.
+        with patch('charmhelpers.core.templating.render') as mock_render:
+            with patch('jujushell.call') as mock_call:
+                jujushell.install_exporter(9117)
+        path = '/usr/lib/systemd/user/jujushell-exporter.service'
+        mock_render.assert_called_once_with(
+            'jujushell-exporter.service', path, {
+                'exporter': '/charm/lib/charms/layer/jujushell_exporter.py',
+                'lxd_socket': '/var/lib/lxd/unix.socket',
+                'metrics': '/charm/files/metrics.json',
+                'pool_prefix': 'termserver-pool-',
+                'port': 9117,
+                'stats': '/charm/files/stats.json',
+                'zfs_pool': 'jujushellstorage',
+            }, perms=775)
+        self.assertEqual([
+            call('systemctl', 'enable', path, timeout=60),
+            call('systemctl', 'daemon-reload', timeout=60),
+            call('systemctl', 'restart', 'jujushell-exporter', timeout=60),
+        ], mock_call.call_args_list)
+        mock_set_flag.assert_called_once_with('jujushell.exporter.installed')
+
+    def test_disabled(self, mock_set_flag, mock_status_set):
+        # The exporter service is removed when the exporter is disabled.
+        with patch('os.path.exists', return_value=True):
+            with patch('os.remove') as mock_remove:
+                with patch('jujushell.call') as mock_call:
+                    jujushell.install_exporter(0)
+        path = '/usr/lib/systemd/user/jujushell-exporter.service'
+        mock_remove.assert_called_once_with(path)
+        self.assertEqual([
+            call('systemctl', 'disable', '--now', 'jujushell-exporter',
+                 timeout=60),
+            call('systemctl', 'daemon-reload', timeout=60),
+        ], mock_call.call_args_list)
+        mock_set_flag.assert_called_once_with('jujushell.exporter.installed')
+
+    def test_disabled_not_installed(self, mock_set_flag, mock_status_set):
+        # Nothing is done if the exporter is disabled and not installed.
+        with patch('os.path.exists', return_value=False):
+            with patch('jujushell.call') as mock_call:
+                jujushell.install_exporter(0)
+        self.assertEqual(0, mock_call.call_count)
+        mock_set_flag.assert_called_once_with('jujushell.exporter.installed')
+
+
+@patch('jujushell._list_containers', list_containers)
 class TestExterminateContainers(unittest.TestCase):
 
     def test_all(self):
@@ -750,15 +2046,37 @@ class TestExterminateContainers(unittest.TestCase):
             ('c3', True),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers()
-        self.assertEqual(removed, ('c1', 'c2', 'c3'))
+            result = jujushell.exterminate_containers()
+        self.assertEqual(result.removed, ('c1', 'c2', 'c3'))
         c1, c2, c3 = client.containers.all()
         c1.stop.assert_called_once_with(wait=True)
-        c1.delete.assert_called_once_with()
+        c1.delete.assert_called_once_with(wait=True)
         self.assertFalse(c2.stop.called)
-        c2.delete.assert_called_once_with()
+        c2.delete.assert_called_once_with(wait=True)
         c3.stop.assert_called_once_with(wait=True)
-        c3.delete.assert_called_once_with()
+        c3.delete.assert_called_once_with(wait=True)
+
+    def test_frozen(self):
+        # Frozen containers are stopped before being removed.
+        with self.patch_lxd_client([('c1', 'Frozen')]) as client:
+            result = jujushell.exterminate_containers()
+        self.assertEqual(result.removed, ('c1',))
+        [c1] = client.containers.all()
+        c1.stop.assert_called_once_with(wait=True)
+        c1.delete.assert_called_once_with(wait=True)
+
+    def test_frozen_only_stopped(self):
+        # Frozen containers are not considered stopped.
+        containers = [
+            ('c1', 'Frozen'),
+            ('c2', False),
+        ]
+        with self.patch_lxd_client(containers) as client:
+            result = jujushell.exterminate_containers(only_stopped=True)
+        self.assertEqual(result.removed, ('c2',))
+        c1, c2 = client.containers.all()
+        self.assertFalse(c1.delete.called)
+        c2.delete.assert_called_once_with(wait=True)
 
     def test_all_dry(self):
         # Exterminate all existing containers (dry run).
@@ -768,8 +2086,8 @@ class TestExterminateContainers(unittest.TestCase):
             ('c3', True),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(dry=True)
-        self.assertEqual(removed, ('c1', 'c2', 'c3'))
+            result = jujushell.exterminate_containers(dry=True)
+        self.assertEqual(result.removed, ('c1', 'c2', 'c3'))
         c1, c2, c3 = client.containers.all()
         self.assertFalse(c1.stop.called)
         self.assertFalse(c1.delete.called)
@@ -781,8 +2099,8 @@ class TestExterminateContainers(unittest.TestCase):
     def test_all_none_existing(self):
         # There is nothing to exterminate if no containers exist.
         with self.patch_lxd_client([]):
-            removed = jujushell.exterminate_containers()
-        self.assertEqual(removed, ())
+            result = jujushell.exterminate_containers()
+        self.assertEqual(result.removed, ())
 
     def test_name(self):
         # Exterminate a specific container.
@@ -791,13 +2109,13 @@ class TestExterminateContainers(unittest.TestCase):
             ('c-bad', True),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(name='c-bad')
-        self.assertEqual(removed, ('c-bad',))
+            result = jujushell.exterminate_containers(name='c-bad')
+        self.assertEqual(result.removed, ('c-bad',))
         cgood, cbad = client.containers.all()
         self.assertFalse(cgood.stop.called)
         self.assertFalse(cgood.delete.called)
         cbad.stop.assert_called_once_with(wait=True)
-        cbad.delete.assert_called_once_with()
+        cbad.delete.assert_called_once_with(wait=True)
 
     def test_name_dry(self):
         # Exterminate a specific container (dry run).
@@ -805,8 +2123,8 @@ class TestExterminateContainers(unittest.TestCase):
             ('c-bad', True),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(name='c-bad', dry=True)
-        self.assertEqual(removed, ('c-bad',))
+            result = jujushell.exterminate_containers(name='c-bad', dry=True)
+        self.assertEqual(result.removed, ('c-bad',))
         [cbad] = client.containers.all()
         self.assertFalse(cbad.stop.called)
         self.assertFalse(cbad.delete.called)
@@ -818,8 +2136,8 @@ class TestExterminateContainers(unittest.TestCase):
             ('c2', False),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(name='no-such')
-        self.assertEqual(removed, ())
+            result = jujushell.exterminate_containers(name='no-such')
+        self.assertEqual(result.removed, ())
         c1, c2 = client.containers.all()
         self.assertFalse(c1.stop.called)
         self.assertFalse(c1.delete.called)
@@ -834,15 +2152,15 @@ class TestExterminateContainers(unittest.TestCase):
             ('c3', False),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(only_stopped=True)
-        self.assertEqual(removed, ('c1', 'c3'))
+            result = jujushell.exterminate_containers(only_stopped=True)
+        self.assertEqual(result.removed, ('c1', 'c3'))
         c1, c2, c3 = client.containers.all()
         self.assertFalse(c1.stop.called)
-        c1.delete.assert_called_once_with()
+        c1.delete.assert_called_once_with(wait=True)
         self.assertFalse(c2.stop.called)
         self.assertFalse(c2.delete.called)
         self.assertFalse(c3.stop.called)
-        c3.delete.assert_called_once_with()
+        c3.delete.assert_called_once_with(wait=True)
 
     def test_only_stopped_dry(self):
         # Exterminate stopped containers (dry run).
@@ -851,9 +2169,9 @@ class TestExterminateContainers(unittest.TestCase):
             ('c2', True),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(
+            result = jujushell.exterminate_containers(
                 only_stopped=True, dry=True)
-        self.assertEqual(removed, ('c1',))
+        self.assertEqual(result.removed, ('c1',))
         c1, c2 = client.containers.all()
         self.assertFalse(c1.stop.called)
         self.assertFalse(c1.delete.called)
@@ -867,8 +2185,8 @@ class TestExterminateContainers(unittest.TestCase):
             ('c2', True),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(only_stopped=True)
-        self.assertEqual(removed, ())
+            result = jujushell.exterminate_containers(only_stopped=True)
+        self.assertEqual(result.removed, ())
         c1, c2 = client.containers.all()
         self.assertFalse(c1.stop.called)
         self.assertFalse(c1.delete.called)
@@ -881,12 +2199,12 @@ class TestExterminateContainers(unittest.TestCase):
             ('mylxc', False),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(
+            result = jujushell.exterminate_containers(
                 name='mylxc', only_stopped=True)
-        self.assertEqual(removed, ('mylxc',))
+        self.assertEqual(result.removed, ('mylxc',))
         [mylxc] = client.containers.all()
         self.assertFalse(mylxc.stop.called)
-        mylxc.delete.assert_called_once_with()
+        mylxc.delete.assert_called_once_with(wait=True)
 
     def test_name_only_stopped_not_found(self):
         # A stopped container with the given name does not exist.
@@ -894,22 +2212,65 @@ class TestExterminateContainers(unittest.TestCase):
             ('mylxc', False),
         ]
         with self.patch_lxd_client(containers) as client:
-            removed = jujushell.exterminate_containers(
+            result = jujushell.exterminate_containers(
                 name='no-such', only_stopped=True)
-        self.assertEqual(removed, ())
+        self.assertEqual(result.removed, ())
         [mylxc] = client.containers.all()
         self.assertFalse(mylxc.stop.called)
         self.assertFalse(mylxc.delete.called)
 
+    def test_failures(self):
+        # Failing to remove a container does not prevent removing others.
+        containers = [
+            ('c1', True),
+            ('c2', False),
+            ('c3', True),
+        ]
+        with self.patch_lxd_client(containers) as client:
+            c1, c2, c3 = client.containers.all()
+            c1.stop.side_effect = ValueError('bad wolf')
+            result = jujushell.exterminate_containers()
+        self.assertEqual(result.removed, ('c2', 'c3'))
+        self.assertEqual(result.failed, {'c1': 'bad wolf'})
+        self.assertEqual(sorted(result.durations), ['c2', 'c3'])
+        self.assertFalse(c1.delete.called)
+        c2.delete.assert_called_once_with(wait=True)
+        c3.delete.assert_called_once_with(wait=True)
+
+    def test_parallelism(self):
+        # Containers are removed concurrently.
+        containers = [('c{}'.format(i), True) for i in range(4)]
+        barrier = threading.Barrier(4, timeout=5)
+        with self.patch_lxd_client(containers) as client:
+            for container in client.containers.all():
+                container.stop.side_effect = lambda wait: barrier.wait()
+            result = jujushell.exterminate_containers(parallelism=4)
+        self.assertEqual(result.removed, ('c0', 'c1', 'c2', 'c3'))
+        self.assertEqual(result.failed, {})
+        for container in client.containers.all():
+            container.delete.assert_called_once_with(wait=True)
+
+    def test_durations(self):
+        # The time spent removing each container is reported.
+        containers = [
+            ('c1', True),
+            ('c2', False),
+        ]
+        with self.patch_lxd_client(containers):
+            with patch('time.monotonic', side_effect=[1, 3, 10, 15]):
+                result = jujushell.exterminate_containers()
+        self.assertEqual(result.durations, {'c1': 2, 'c2': 5})
+
     def patch_lxd_client(self, containers):
         """Patch the LXD client and make it return the given containers.
 
-        Containers are expressed as tuples (name: str, running: bool).
+        Containers are expressed as tuples (name: str, running: bool). A
+        status string, like "Frozen", can be provided in place of running.
         """
         results = [
             type('Container', (object,), {
                 'name': name,
-                'status': 'Running' if running else 'Stopped',
+                'status': _status(running),
                 'stop': Mock(),
                 'delete': Mock(),
             }) for name, running in containers
@@ -921,32 +2282,379 @@ class TestExterminateContainers(unittest.TestCase):
         }))
 
 
-class TestServiceURL(unittest.TestCase):
+@patch('jujushell._list_containers', list_containers)
+@patch('charmhelpers.core.hookenv.log')
+class TestWarmPool(unittest.TestCase):
+
+    def test_refill_pool(self, mock_log):
+        # Missing pool containers are created.
+        containers = [
+            ('termserver-pool-1', False),
+            ('termserver-pool-2', True),
+            ('c1', False),
+        ]
+        with self.patch_lxd_client(containers) as client:
+            created = jujushell.refill_pool(3)
+        self.assertEqual(2, len(created))
+        for name in created:
+            self.assertTrue(name.startswith('termserver-pool-'))
+        client.containers.create.assert_has_calls([
+            call({
+                'name': name,
+                'profiles': ['termserver', 'termserver-limited'],
+                'source': {'type': 'image', 'alias': 'termserver'},
+            }, wait=False) for name in created
+        ])
+        self.assertEqual(2, client.containers.create.call_count)
+
+    def test_refill_pool_full(self, mock_log):
+        # No containers are created if the pool is full.
+        containers = [
+            ('termserver-pool-1', False),
+        ]
+        with self.patch_lxd_client(containers) as client:
+            created = jujushell.refill_pool(1)
+        self.assertEqual((), created)
+        self.assertFalse(client.containers.create.called)
+
+    def test_refill_pool_shrink(self, mock_log):
+        # Exceeding pool containers are removed.
+        containers = [
+            ('termserver-pool-1', False),
+            ('termserver-pool-2', False),
+            ('termserver-pool-3', False),
+        ]
+        with self.patch_lxd_client(containers) as client:
+            created = jujushell.refill_pool(1)
+        self.assertEqual((), created)
+        self.assertFalse(client.containers.create.called)
+        c1, c2, c3 = client.containers.all()
+        self.assertFalse(c1.delete.called)
+        c2.delete.assert_called_once_with(wait=True)
+        c3.delete.assert_called_once_with(wait=True)
+
+    def test_empty_pool(self, mock_log):
+        # All stopped pool containers are removed.
+        containers = [
+            ('termserver-pool-1', False),
+            ('termserver-pool-2', True),
+            ('c1', False),
+        ]
+        with self.patch_lxd_client(containers) as client:
+            removed = jujushell.empty_pool()
+        self.assertEqual(('termserver-pool-1',), removed)
+        c1, c2, c3 = client.containers.all()
+        c1.delete.assert_called_once_with(wait=True)
+        self.assertFalse(c2.delete.called)
+        self.assertFalse(c3.delete.called)
+
+    def patch_lxd_client(self, containers):
+        """Patch the LXD client and make it return the given containers.
+
+        Containers are expressed as tuples (name: str, running: bool).
+        """
+        results = []
+        for name, running in containers:
+            container = Mock(status='Running' if running else 'Stopped')
+            # The name attribute cannot be set when creating a mock.
+            container.name = name
+            results.append(container)
+        client = Mock()
+        client.containers.all.return_value = results
+        return patch_lxd_client(client)
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestReapContainers(unittest.TestCase):
+
+    def setUp(self):
+        self.kv = patch_kv(self)
+        # Fri, 01 Jun 2018 12:00:00 GMT.
+        self.now = 1527854400
+        patcher = patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stopped(self, mock_log):
+        # Old stopped containers are removed.
+        containers = [
+            self.make_data('c1', 'Stopped', '2018-06-01T10:00:00Z'),
+            self.make_data('c2', 'Stopped', '2018-06-01T11:45:00.42+00:00'),
+            self.make_data('c3', 'Running', '2018-06-01T08:00:00Z'),
+            self.make_data('c4', 'Stopped', '1970-01-01T00:00:00Z',
+                           created_at='2018-06-01T11:50:00Z'),
+            self.make_data('termserver-pool-1', 'Stopped',
+                           '2018-05-01T10:00:00Z'),
+        ]
+        with self.patch_lxd_client(containers) as models:
+            removed, frozen = jujushell.reap_containers(30, 0)
+        self.assertEqual(('c1',), removed)
+        self.assertEqual((), frozen)
+        models['c1'].delete.assert_called_once_with(wait=True)
+        self.assertEqual(['c1'], list(models))
+
+    def test_idle(self, mock_log):
+        # Running containers not using CPU are frozen.
+        containers = [
+            self.make_data('c1', 'Running', usage=100),
+            self.make_data('c2', 'Running', usage=200),
+            self.make_data('c3', 'Stopped'),
+        ]
+        # The CPU usage is sampled for the first time.
+        with self.patch_lxd_client(containers) as models:
+            removed, frozen = jujushell.reap_containers(0, 10)
+        self.assertEqual((), removed)
+        self.assertEqual((), frozen)
+        self.assertEqual({}, models)
+        # The first container uses some CPU.
+        self.now += 300
+        containers[0]['state']['cpu']['usage'] = 142
+        with self.patch_lxd_client(containers) as models:
+            removed, frozen = jujushell.reap_containers(0, 10)
+        self.assertEqual((), frozen)
+        # The second container is now idle.
+        self.now += 300
+        with self.patch_lxd_client(containers) as models:
+            removed, frozen = jujushell.reap_containers(0, 10)
+        self.assertEqual((), removed)
+        self.assertEqual(('c2',), frozen)
+        models['c2'].freeze.assert_called_once_with(wait=True)
+        self.assertEqual(['c1'], sorted(
+            self.kv.get(jujushell._CPU_SAMPLES_KEY)))
+
+    def test_errors(self, mock_log):
+        # Containers that cannot be removed or frozen are skipped.
+        containers = [
+            self.make_data('c1', 'Stopped', '2018-06-01T10:00:00Z'),
+            self.make_data('c2', 'Stopped', '2018-06-01T10:00:00Z'),
+            self.make_data('c3', 'Running', usage=100),
+            self.make_data('c4', 'Running', usage=200),
+        ]
+        response = Mock()
+        response.json.return_value = {'error': 'not found'}
+        error = exceptions.LXDAPIException(response)
+        with self.patch_lxd_client(containers):
+            jujushell.reap_containers(30, 10)
+        self.now += 600
+        with self.patch_lxd_client(containers) as models:
+            models['c1'] = Mock()
+            models['c1'].delete.side_effect = error
+            models['c3'] = Mock()
+            models['c3'].freeze.side_effect = error
+            removed, frozen = jujushell.reap_containers(30, 10)
+        self.assertEqual(('c2',), removed)
+        self.assertEqual(('c4',), frozen)
+        mock_log.assert_any_call('cannot remove container c1: not found')
+        mock_log.assert_any_call('cannot freeze container c3: not found')
+        # CPU samples are saved, and freezing is retried later.
+        self.assertEqual(['c3'], sorted(
+            self.kv.get(jujushell._CPU_SAMPLES_KEY)))
+
+    def test_frozen(self, mock_log):
+        # Containers are removed after being frozen for the stopped age.
+        containers = [
+            self.make_data('c1', 'Frozen'),
+            self.make_data('c2', 'Running', usage=100),
+        ]
+        with self.patch_lxd_client(containers):
+            jujushell.reap_containers(30, 10)
+        # The second container is frozen.
+        self.now += 600
+        with self.patch_lxd_client(containers):
+            removed, frozen = jujushell.reap_containers(30, 10)
+        self.assertEqual((), removed)
+        self.assertEqual(('c2',), frozen)
+        containers[1]['status'] = 'Frozen'
+        # The first container has been frozen for long enough.
+        self.now += 1200
+        with self.patch_lxd_client(containers) as models:
+            removed, frozen = jujushell.reap_containers(30, 10)
+        self.assertEqual(('c1',), removed)
+        models['c1'].stop.assert_called_once_with(wait=True)
+        models['c1'].delete.assert_called_once_with(wait=True)
+        self.assertEqual(['c1'], list(models))
+        # And then the second one.
+        self.now += 600
+        with self.patch_lxd_client(containers[1:]) as models:
+            removed, frozen = jujushell.reap_containers(30, 10)
+        self.assertEqual(('c2',), removed)
+        self.assertEqual({}, self.kv.get(jujushell._FROZEN_KEY))
+
+    def test_frozen_disabled(self, mock_log):
+        # Frozen containers are not removed if stopped_age is zero.
+        containers = [self.make_data('c1', 'Frozen')]
+        with self.patch_lxd_client(containers):
+            jujushell.reap_containers(0, 10)
+        self.now += 60 * 60 * 24
+        with self.patch_lxd_client(containers) as models:
+            removed, frozen = jujushell.reap_containers(0, 10)
+        self.assertEqual((), removed)
+        self.assertEqual({}, models)
+
+    def test_idle_without_state(self, mock_log):
+        # The container state is retrieved if not included in the listing.
+        data = self.make_data('c1', 'Running')
+        del data['state']
+        with self.patch_lxd_client([data]):
+            client = jujushell._lxd_client()
+            client.api.containers['c1'].state.get().json.return_value = {
+                'metadata': {'cpu': {'usage': 42}},
+            }
+            jujushell.reap_containers(0, 10)
+        self.assertEqual(
+            {'c1': {'usage': 42, 'since': self.now}},
+            self.kv.get(jujushell._CPU_SAMPLES_KEY))
+
+    def test_disabled(self, mock_log):
+        # Nothing happens if both operations are disabled.
+        with self.patch_lxd_client([]):
+            removed, frozen = jujushell.reap_containers(0, 0)
+            self.assertFalse(jujushell._lxd_client().api.containers.get.called)
+        self.assertEqual((), removed)
+        self.assertEqual((), frozen)
+
+    def make_data(
+            self, name, status, last_used_at='', created_at='', usage=0):
+        """Return container data as returned by the LXD API."""
+        return {
+            'name': name,
+            'status': status,
+            'created_at': created_at,
+            'last_used_at': last_used_at,
+            'state': {'cpu': {'usage': usage}},
+        }
+
+    @contextlib.contextmanager
+    def patch_lxd_client(self, containers):
+        """Patch the LXD client so that the given containers are returned.
+
+        Yield a dictionary mapping names to container models created while
+        reaping containers.
+        """
+        client = MagicMock()
+        client.api.containers.get.return_value.json.return_value = {
+            'metadata': containers,
+        }
+        models = {}
+
+        def container_from_data(client, data):
+            return models.setdefault(data['name'], Mock())
+
+        with patch_lxd_client(client):
+            with patch('jujushell._container_from_data', container_from_data):
+                yield models
+
+
+class TestListContainers(unittest.TestCase):
+
+    def test_all(self):
+        # All containers are retrieved with a single API call.
+        client = MagicMock()
+        client.api.containers.get().json.return_value = {'metadata': [{
+            'name': 'c1',
+            'status': 'Running',
+            'config': {'volatile.base_image': 'i1'},
+            'no-such-attribute': 42,
+        }, {
+            'name': 'c2',
+            'status': 'Stopped',
+            'config': {},
+        }]}
+        c1, c2 = jujushell._list_containers(client)
+        client.api.containers.get.assert_called_with(params={'recursion': 1})
+        self.assertEqual('c1', c1.name)
+        self.assertEqual('Running', c1.status)
+        self.assertEqual({'volatile.base_image': 'i1'}, c1.config)
+        self.assertEqual('c2', c2.name)
+        self.assertEqual('Stopped', c2.status)
+        self.assertFalse(client.containers.get.called)
+
+    def test_name(self):
+        # A container is retrieved by name.
+        client = Mock()
+        containers = jujushell._list_containers(client, name='c1')
+        client.containers.get.assert_called_once_with('c1')
+        self.assertEqual([client.containers.get()], containers)
+        self.assertFalse(client.api.containers.get.called)
+
+    def test_name_not_found(self):
+        # No containers are returned if a container is not found by name.
+        client = Mock()
+        client.containers.get.side_effect = exceptions.NotFound(Mock())
+        containers = jujushell._list_containers(client, name='c1')
+        self.assertEqual([], containers)
+
+
+class TestServiceURLs(unittest.TestCase):
 
     tests = [{
         'about': 'insecure ip',
         'config': {'port': 8042},
-        'want_url': 'http://localhost:8042/metrics',
+        'want_urls': ['http://localhost:8042/metrics'],
     }, {
         'about': 'dns name provided',
         'config': {'dns-name': 'example.com', 'port': 443},
-        'want_url': 'https://example.com:443/metrics',
+        'want_urls': ['https://example.com:443/metrics'],
     }, {
         'about': 'certs provided',
         'config': {'port': 4242, 'tls-cert': 'cert'},
-        'want_url': 'https://localhost:4242/metrics',
+        'want_urls': ['https://localhost:4242/metrics'],
     }, {
         'about': 'dns name and certs provided',
         'config': {'dns-name': 'example.com', 'port': 443, 'tls-cert': 'cert'},
-        'want_url': 'https://example.com:443/metrics',
+        'want_urls': ['https://example.com:443/metrics'],
+    }, {
+        'about': 'metrics listener',
+        'config': {
+            'dns-name': 'example.com',
+            'metrics-addr': '127.0.0.1:8048',
+            'port': 443,
+        },
+        'want_urls': [
+            'http://127.0.0.1:8048/metrics',
+            'https://example.com:443/metrics',
+        ],
     }]
 
-    def test_service_url(self):
-        # The service URL is inferred from its configuration.
+    def test_service_urls(self):
+        # The service URLs are inferred from its configuration.
         for test in self.tests:
             with self.subTest(test['about']):
-                url = jujushell.service_url(test['config'])
-                self.assertEqual(url, test['want_url'])
+                urls = jujushell.service_urls(test['config'])
+                self.assertEqual(urls, test['want_urls'])
+
+
+def _status(running):
+    """Return the container status corresponding to the given running value.
+
+    The value is returned unchanged if it is already a status string.
+    """
+    if isinstance(running, str):
+        return running
+    return 'Running' if running else 'Stopped'
+
+
+def patch_lxd_client(client):
+    """Patch the LXD client so that the given mock client is used.
+
+    Calling the mock returns the mock itself, so that the client can be
+    accessed from tests when the returned patcher is used as a context
+    manager.
+    """
+    client.return_value = client
+    return patch('jujushell._lxd_client', client)
+
+
+def patch_kv(test):
+    """Patch the unit key/value store for the duration of the given test.
+
+    Return the in-memory store used in place of the unit one.
+    """
+    kv = unitdata.Storage(':memory:')
+    patcher = patch('charmhelpers.core.unitdata.kv', return_value=kv)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return kv
 
 
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import argparse
+from http import server
+import json
+import os
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+_layer = os.path.join(_root, 'lib', 'charms', 'layer')
+sys.path.insert(0, _layer)
+
+# jujushell_exporter can only be imported after the layer directory has been
+# added to the python path.
+import jujushell_exporter  # noqa: E402
+
+
+class TestParseBytes(unittest.TestCase):
+
+    tests = [{
+        'about': 'bytes',
+        'value': '1024',
+        'want': 1024,
+    }, {
+        'about': 'bytes with suffix',
+        'value': '42B',
+        'want': 42,
+    }, {
+        'about': 'decimal units',
+        'value': '512MB',
+        'want': 512000000,
+    }, {
+        'about': 'binary units',
+        'value': '2GiB',
+        'want': 2147483648,
+    }, {
+        'about': 'fractional units',
+        'value': '1.5kB',
+        'want': 1500,
+    }, {
+        'about': 'percentage',
+        'value': '50%',
+        'want': None,
+    }, {
+        'about': 'empty',
+        'value': '',
+        'want': None,
+    }]
+
+    def test_parse_bytes(self):
+        # LXD size values are parsed as bytes.
+        for test in self.tests:
+            with self.subTest(test['about']):
+                value = jujushell_exporter.parse_bytes(test['value'])
+                self.assertEqual(test['want'], value)
+
+
+class TestCollect(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.requests = []
+        self.containers = [
+            make_container('termserver-pool-1', 'Stopped'),
+            make_container('termserver-pool-2', 'Stopped'),
+            make_container(
+                'termserver-who', 'Running', cpu=2500000000, memory=1024,
+                processes=7, limits={
+                    'limits.cpu': '2',
+                    'limits.memory': '1GB',
+                    'limits.processes': '500',
+                }),
+            make_container(
+                'termserver-rose', 'Stopped', processes=-1, limits={
+                    'limits.memory': '50%',
+                }),
+        ]
+        self.options = argparse.Namespace(
+            lxd_socket=os.path.join(directory, 'lxd.socket'),
+            metrics=os.path.join(directory, 'metrics.json'),
+            pool_prefix='termserver-pool-',
+            stats=os.path.join(directory, 'stats.json'),
+            zfs_pool='jujushellstorage',
+        )
+        self.serve_lxd(self.options.lxd_socket)
+
+    def serve_lxd(self, path):
+        """Serve a fake LXD API on a unix socket at the given path."""
+        test = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                test.requests.append(self.path)
+                content = json.dumps({
+                    'metadata': test.containers,
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = socketserver.UnixStreamServer(path, Handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+
+    def collect(self, zfs_output=b'1000\t9000\n', service='service_up 1\n'):
+        """Collect metrics and return them as a list of lines."""
+        with patch('subprocess.check_output') as mock_check_output:
+            if isinstance(zfs_output, Exception):
+                mock_check_output.side_effect = zfs_output
+            else:
+                mock_check_output.return_value = zfs_output
+            with patch('jujushell_metrics.fetch') as mock_fetch:
+                if service is None:
+                    mock_fetch.side_effect = OSError('bad wolf')
+                else:
+                    mock_fetch.return_value = service
+                with open(self.options.metrics, 'w') as stream:
+                    json.dump({
+                        'metrics': [],
+                        'urls': ['http://localhost:4247/metrics'],
+                    }, stream)
+                text = jujushell_exporter.collect(self.options)
+        mock_check_output.assert_called_once_with(
+            ['zfs', 'get', '-Hp', '-o', 'value', 'used,available',
+             'jujushellstorage'],
+            stderr=subprocess.DEVNULL, timeout=10)
+        self.assertTrue(text.endswith('\n'))
+        return text.splitlines()
+
+    def test_containers(self):
+        # Container metrics are collected with a single LXD request.
+        lines = self.collect()
+        self.assertEqual(['/1.0/containers?recursion=2'], self.requests)
+        for line in (
+            'jujushell_lxd_up 1',
+            '# TYPE jujushell_container_cpu_seconds_total counter',
+            'jujushell_container_cpu_seconds_total{container="termserver-who"}'
+            ' 2.5',
+            'jujushell_container_memory_bytes{container="termserver-who"}'
+            ' 1024',
+            'jujushell_container_memory_bytes{container="termserver-rose"} 0',
+            'jujushell_container_processes{container="termserver-who"} 7',
+            'jujushell_container_cpu_limit{container="termserver-who"} 2',
+            'jujushell_container_memory_limit_bytes'
+            '{container="termserver-who"} 1000000000',
+            'jujushell_container_processes_limit'
+            '{container="termserver-who"} 500',
+            'jujushell_containers{status="running"} 1',
+            'jujushell_containers{status="stopped"} 3',
+            'jujushell_pool_containers 2',
+        ):
+            self.assertIn(line, lines)
+        # Invalid values and pool containers are not reported.
+        for line in lines:
+            self.assertNotIn('termserver-pool-', line)
+            self.assertFalse(line.startswith(
+                'jujushell_container_processes{container="termserver-rose"}'))
+            self.assertFalse(line.startswith(
+                'jujushell_container_memory_limit_bytes'
+                '{container="termserver-rose"}'))
+
+    def test_lxd_error(self):
+        # LXD errors are reported.
+        self.options.lxd_socket += '-no-such'
+        lines = self.collect()
+        self.assertIn('jujushell_lxd_up 0', lines)
+        self.assertNotIn('jujushell_pool_containers 0', lines)
+
+    def test_zfs(self):
+        # ZFS storage pool usage is reported.
+        lines = self.collect()
+        for line in (
+            'jujushell_zfs_up{pool="jujushellstorage"} 1',
+            'jujushell_zfs_used_bytes{pool="jujushellstorage"} 1000',
+            'jujushell_zfs_available_bytes{pool="jujushellstorage"} 9000',
+        ):
+            self.assertIn(line, lines)
+
+    def test_zfs_error(self):
+        # ZFS errors are reported.
+        lines = self.collect(zfs_output=OSError('bad wolf'))
+        self.assertIn('jujushell_zfs_up{pool="jujushellstorage"} 0', lines)
+        for line in lines:
+            self.assertFalse(line.startswith('jujushell_zfs_used_bytes'))
+
+    def test_image_imports(self):
+        # Image import durations are reported.
+        with open(self.options.stats, 'w') as stream:
+            json.dump({'image-imports': {
+                'termserver-full': {'seconds': 42.5, 'time': 1500000000.0},
+            }}, stream)
+        lines = self.collect()
+        for line in (
+            'jujushell_image_import_seconds{image="termserver-full"} 42.5',
+            'jujushell_image_import_timestamp_seconds'
+            '{image="termserver-full"} 1500000000.0',
+        ):
+            self.assertIn(line, lines)
+
+    def test_service(self):
+        # The jujushell service metrics are included.
+        lines = self.collect(service='jujushell_requests_count 42')
+        self.assertIn('jujushell_service_up 1', lines)
+        self.assertEqual('jujushell_requests_count 42', lines[-1])
+
+    def test_service_error(self):
+        # Errors retrieving jujushell service metrics are reported.
+        lines = self.collect(service=None)
+        self.assertIn('jujushell_service_up 0', lines)
+
+    def test_help(self):
+        # Each metric family is described once.
+        lines = self.collect()
+        types = [line for line in lines if line.startswith('# TYPE ')]
+        self.assertEqual(len(set(types)), len(types))
+        self.assertIn('# TYPE jujushell_container_memory_bytes gauge', types)
+
+
+def make_container(
+        name, status, cpu=0, memory=0, processes=0, limits=None):
+    """Return a container as returned by the LXD API with recursion=2."""
+    return {
+        'expanded_config': limits or {},
+        'name': name,
+        'state': {
+            'cpu': {'usage': cpu},
+            'memory': {'usage': memory},
+            'processes': processes,
+        },
+        'status': status,
+    }
+
+
+if __name__ == '__main__':
+    unittest.main()
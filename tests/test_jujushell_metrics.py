@@ -0,0 +1,396 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+from http import server
+import json
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+_layer = os.path.join(_root, 'lib', 'charms', 'layer')
+sys.path.insert(0, _layer)
+
+# jujushell_metrics can only be imported after the layer directory has been
+# added to the python path.
+import jujushell_metrics  # noqa: E402
+
+
+class TestParse(unittest.TestCase):
+
+    def test_samples(self):
+        # Samples are parsed from the Prometheus text format.
+        text = (
+            '# HELP jujushell_requests_count Count of requests.\n'
+            '# TYPE jujushell_requests_count gauge\n'
+            'jujushell_requests_count 42\n'
+            '\n'
+            'jujushell_requests_duration_sum 3.5e-01\n'
+            'jujushell_errors_count{code="500",msg="a b}"} 2 1500000000\n'
+        )
+        self.assertEqual([
+            ('jujushell_requests_count', '', 42),
+            ('jujushell_requests_duration_sum', '', 0.35),
+            ('jujushell_errors_count', 'code="500",msg="a b}"', 2),
+        ], list(jujushell_metrics.parse(text)))
+
+    def test_invalid_samples(self):
+        # Samples without a valid value are ignored.
+        text = 'no_value\nbad_value bad\ngood_value +Inf\n'
+        self.assertEqual(
+            [('good_value', '', float('inf'))],
+            list(jujushell_metrics.parse(text)))
+
+
+class TestRetrieve(unittest.TestCase):
+
+    def setUp(self):
+        # Serve metrics from a local HTTP server.
+        test = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+
+            # Support keep-alive connections.
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                test.paths.append(self.path)
+                test.clients.add(self.client_address)
+                time.sleep(test.delay)
+                content = test.text.encode('utf-8')
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                except ConnectionError:
+                    # The client gave up waiting.
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self.clients = set()
+        self.delay = 0
+        self.paths = []
+        self.text = (
+            'jujushell_containers_in_flight 3\n'
+            'jujushell_requests_count 42\n'
+            'go_goroutines 12\n'
+        )
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/metrics'.format(
+            self.server.server_address[1])
+        self.addCleanup(close_connections)
+
+    def test_retrieve(self):
+        # Samples are retrieved and renamed after the requested metrics.
+        samples = jujushell_metrics.retrieve(
+            [self.url],
+            ('containers_in_flight', 'errors_count', 'requests_count'))
+        self.assertEqual([
+            ('containers_in_flight', 3),
+            ('requests_count', 42),
+        ], samples)
+        self.assertEqual(['/metrics'], self.paths)
+
+    def test_percentiles(self):
+        # Percentiles are estimated from histogram buckets.
+        self.text = (
+            'jujushell_requests_duration_bucket{method="GET",le="0.1"} 50\n'
+            'jujushell_requests_duration_bucket{method="GET",le="1"} 90\n'
+            'jujushell_requests_duration_bucket{method="GET",le="+Inf"} 100\n'
+            'jujushell_requests_duration_bucket{method="PUT",le="0.1"} 50\n'
+            'jujushell_requests_duration_bucket{method="PUT",le="1"} 90\n'
+            'jujushell_requests_duration_bucket{method="PUT",le="+Inf"} 100\n'
+            'jujushell_requests_duration_sum 42\n'
+            'jujushell_requests_duration_count 200\n'
+        )
+        samples = jujushell_metrics.retrieve([self.url], (
+            'containers_duration_p50',
+            'requests_duration_p50',
+            'requests_duration_p80',
+            'requests_duration_p99',
+            'requests_duration_sum',
+        ))
+        self.assertEqual([
+            ('requests_duration_p50', 0.1),
+            ('requests_duration_p80', 0.775),
+            ('requests_duration_p99', 1),
+            ('requests_duration_sum', 42),
+        ], samples)
+
+    def test_no_metrics(self):
+        # The service is not queried if no metrics are requested.
+        self.assertEqual([], jujushell_metrics.retrieve([self.url], ()))
+        self.assertEqual([], self.paths)
+
+    def test_error(self):
+        # An OSError is raised if metrics cannot be retrieved.
+        url = 'http://127.0.0.1:{}/no-such'.format(
+            self.server.server_address[1])
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(OSError) as ctx:
+            jujushell_metrics.retrieve([url], ('requests_count',), timeout=1)
+        self.assertIn(
+            'cannot retrieve metrics from {}'.format(url), str(ctx.exception))
+
+    def test_fallback(self):
+        # Metrics are retrieved from the next URL if the first one fails.
+        bad_url = 'http://127.0.0.1:{}/metrics'.format(unused_port())
+        samples = jujushell_metrics.retrieve(
+            [bad_url, self.url], ('requests_count',))
+        self.assertEqual([('requests_count', 42)], samples)
+        self.assertEqual(['/metrics'], self.paths)
+
+    def test_fallback_error(self):
+        # The last error is reported if no URL can be used.
+        bad_url = 'http://127.0.0.1:{}/metrics'.format(unused_port())
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(OSError) as ctx:
+            jujushell_metrics.retrieve(
+                [bad_url, self.url], ('requests_count',), timeout=1)
+        self.assertIn(
+            'cannot retrieve metrics from {}'.format(self.url),
+            str(ctx.exception))
+
+    def test_deadline(self):
+        # An OSError is raised if metrics are not retrieved in time.
+        self.delay = 1
+        start = time.monotonic()
+        with self.assertRaises(OSError) as ctx:
+            jujushell_metrics.retrieve(
+                [self.url], ('requests_count',), timeout=0.2)
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertIn('timed out', str(ctx.exception))
+
+    def test_connection_reused(self):
+        # The same connection is used for subsequent requests.
+        for _ in range(3):
+            jujushell_metrics.retrieve([self.url], ('requests_count',))
+        self.assertEqual(3, len(self.paths))
+        self.assertEqual(1, len(self.clients))
+
+    def test_connection_closed(self):
+        # A new connection is made if the previous one has been closed.
+        jujushell_metrics.retrieve([self.url], ('requests_count',))
+        for conn in jujushell_metrics._connections.values():
+            conn.sock.close()
+        samples = jujushell_metrics.retrieve([self.url], ('requests_count',))
+        self.assertEqual([('requests_count', 42)], samples)
+        self.assertEqual(2, len(self.clients))
+
+    def make_metrics_file(self, metrics):
+        """Create a metrics file including the given metric names.
+
+        Return the path to the file.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'metrics.json')
+        with open(path, 'w') as stream:
+            json.dump({'metrics': metrics, 'urls': [self.url]}, stream)
+        return path
+
+    def test_main(self):
+        # Metrics described by the metrics file are added to Juju.
+        path = self.make_metrics_file(['metrics_staleness', 'requests_count'])
+        with patch('subprocess.check_call') as mock_check_call:
+            jujushell_metrics.main(path)
+        mock_check_call.assert_called_once_with(
+            ['add-metric', 'requests_count=42.0', 'metrics_staleness=0.0'])
+
+    def test_main_cached(self):
+        # Cached samples are reported if metrics cannot be retrieved.
+        path = self.make_metrics_file(['metrics_staleness', 'requests_count'])
+        with patch('subprocess.check_call'):
+            jujushell_metrics.main(path)
+        self.text = 'jujushell_requests_count 47\n'
+        self.delay = 1
+        with patch('jujushell_metrics._DEADLINE', 0.2):
+            with patch('time.time', return_value=time.time() + 60):
+                with patch('sys.stderr'):
+                    with patch('subprocess.check_call') as mock_check_call:
+                        jujushell_metrics.main(path)
+        args = mock_check_call.call_args[0][0]
+        self.assertEqual(['add-metric', 'requests_count=42.0'], args[:2])
+        name, value = args[2].split('=')
+        self.assertEqual('metrics_staleness', name)
+        self.assertAlmostEqual(60, float(value), delta=5)
+
+    def test_main_cache_expired(self):
+        # Old cached samples are not reported.
+        path = self.make_metrics_file(['metrics_staleness', 'requests_count'])
+        with patch('subprocess.check_call'):
+            jujushell_metrics.main(path)
+        self.server.shutdown()
+        self.server.server_close()
+        close_connections()
+        with patch('time.time', return_value=time.time() + 7200):
+            with patch('sys.stderr'):
+                with patch('subprocess.check_call') as mock_check_call:
+                    jujushell_metrics.main(path)
+        args = mock_check_call.call_args[0][0]
+        self.assertEqual(2, len(args))
+        self.assertTrue(args[1].startswith('metrics_staleness='))
+
+    def test_main_no_cache(self):
+        # Nothing is reported if metrics were never retrieved.
+        path = self.make_metrics_file(['metrics_staleness', 'requests_count'])
+        self.server.shutdown()
+        self.server.server_close()
+        with patch('sys.stderr'):
+            with patch('subprocess.check_call') as mock_check_call:
+                jujushell_metrics.main(path)
+        self.assertEqual(0, mock_check_call.call_count)
+
+
+class TestQuantile(unittest.TestCase):
+
+    tests = [{
+        'about': 'no buckets',
+        'q': 0.5,
+        'buckets': [],
+        'want': None,
+    }, {
+        'about': 'no observations',
+        'q': 0.5,
+        'buckets': [(1, 0), (float('inf'), 0)],
+        'want': None,
+    }, {
+        'about': 'first bucket',
+        'q': 0.5,
+        'buckets': [(2, 10), (4, 10), (float('inf'), 10)],
+        'want': 1,
+    }, {
+        'about': 'interpolation',
+        'q': 0.75,
+        'buckets': [(float('inf'), 20), (1, 10), (3, 20)],
+        'want': 2,
+    }, {
+        'about': 'infinite bucket',
+        'q': 0.99,
+        'buckets': [(1, 10), (3, 20), (float('inf'), 40)],
+        'want': 3,
+    }, {
+        'about': 'empty bucket',
+        'q': 0.5,
+        'buckets': [(1, 0), (3, 10), (5, 10), (float('inf'), 10)],
+        'want': 2,
+    }, {
+        'about': 'minimum',
+        'q': 0,
+        'buckets': [(1, 0), (3, 10), (float('inf'), 10)],
+        'want': 1,
+    }]
+
+    def test_quantile(self):
+        # Quantiles are estimated like the Prometheus histogram_quantile.
+        for test in self.tests:
+            with self.subTest(test['about']):
+                value = jujushell_metrics.quantile(test['q'], test['buckets'])
+                self.assertEqual(test['want'], value)
+
+
+class TestAdd(unittest.TestCase):
+
+    def test_add(self):
+        # Samples are added using the add-metric command.
+        with patch('subprocess.check_call') as mock_check_call:
+            jujushell_metrics.add([('a', 1.0), ('b', 2.5)])
+        mock_check_call.assert_called_once_with(
+            ['add-metric', 'a=1.0', 'b=2.5'])
+
+    def test_no_samples(self):
+        # The add-metric command is not run if there are no samples.
+        with patch('subprocess.check_call') as mock_check_call:
+            jujushell_metrics.add([])
+        self.assertEqual(0, mock_check_call.call_count)
+
+
+class TestStartup(unittest.TestCase):
+
+    def import_module(self, name):
+        """Import the given module in a new interpreter.
+
+        Return the wall time in seconds, taking the best of a few runs, and
+        the names of the modules imported by the given one.
+        """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [_layer] + sys.path))
+        code = (
+            'import sys; before = set(sys.modules); import {}; '
+            'print(" ".join(set(sys.modules) - before))'
+        ).format(name)
+        best = None
+        for _ in range(3):
+            start = time.monotonic()
+            output = subprocess.check_output(
+                [sys.executable, '-c', code], env=env,
+                stderr=subprocess.DEVNULL)
+            elapsed = time.monotonic() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, output.decode('utf-8').split()
+
+    def test_dependencies(self):
+        # The metrics module only depends on the standard library.
+        _, modules = self.import_module('jujushell_metrics')
+        for name in ('charmhelpers', 'charms', 'jujushell', 'yaml'):
+            self.assertNotIn(name, modules)
+
+    def test_import_time(self):
+        # Starting the metrics module is faster than starting the charm lib.
+        try:
+            full, _ = self.import_module('jujushell')
+        except subprocess.CalledProcessError:
+            self.skipTest('the charm lib cannot be imported')
+        light, _ = self.import_module('jujushell_metrics')
+        self.assertLess(
+            light, full,
+            'metrics: {:.3f}s, charm lib: {:.3f}s'.format(light, full))
+
+
+class _Server(socketserver.ThreadingMixIn, server.HTTPServer):
+    """An HTTP server handling each connection in a separate thread.
+
+    This is equivalent to http.server.ThreadingHTTPServer, which is not
+    available before Python 3.7.
+    """
+
+    daemon_threads = True
+
+
+def unused_port():
+    """Return a local TCP port on which nothing is listening."""
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def close_connections():
+    """Close the connections kept open by jujushell_metrics."""
+    while jujushell_metrics._connections:
+        _, conn = jujushell_metrics._connections.popitem()
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()